@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This file is part of the CernVM File System auxiliary tools.
+
+Micro-benchmark comparing catalog lookups through literal SQL strings (a new
+statement is parsed and planned for every lookup) with lookups through bound
+parameters (the prepared statement is reused from the connection's cache).
+
+Usage: benchmark_catalog_lookups.py [CATALOG_DB [NUM_LOOKUPS]]
+  Without a catalog a synthetic one with 100000 entries is generated.
+"""
+
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cvmfs
+from cvmfs.catalog import Catalog
+from cvmfs.dirent  import DirectoryEntry
+
+
+def make_synthetic_catalog(num_entries):
+    handle, path = tempfile.mkstemp(prefix='bench_catalog_')
+    os.close(handle)
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE properties (key TEXT, value TEXT,
+          CONSTRAINT pk_properties PRIMARY KEY (key));
+        CREATE TABLE catalog (md5path_1 INTEGER, md5path_2 INTEGER,
+          parent_1 INTEGER, parent_2 INTEGER, hardlinks INTEGER, hash BLOB,
+          size INTEGER, mode INTEGER, mtime INTEGER, flags INTEGER, name TEXT,
+          symlink TEXT, uid INTEGER, gid INTEGER, xattr BLOB,
+          CONSTRAINT pk_catalog PRIMARY KEY (md5path_1, md5path_2));
+        CREATE INDEX idx_catalog_parent ON catalog (parent_1, parent_2);
+        CREATE TABLE chunks (md5path_1 INTEGER, md5path_2 INTEGER,
+          offset INTEGER, size INTEGER, hash BLOB,
+          CONSTRAINT pk_chunks PRIMARY KEY (md5path_1, md5path_2, offset, size));
+        CREATE TABLE nested_catalogs (path TEXT, sha1 TEXT, size INTEGER,
+          CONSTRAINT pk_nested_catalogs PRIMARY KEY (path));
+        INSERT INTO properties VALUES ('revision', '1');
+        INSERT INTO properties VALUES ('schema', '2.5');
+        INSERT INTO properties VALUES ('schema_revision', '3');
+        INSERT INTO properties VALUES ('last_modified', '0');
+    """)
+    root_1, root_2 = cvmfs._split_md5(hashlib.md5('').digest())
+    rows = []
+    for i in xrange(num_entries):
+        name = 'file%d' % i
+        md5_1, md5_2 = cvmfs._split_md5(hashlib.md5('/' + name).digest())
+        rows.append((md5_1, md5_2, root_1, root_2, 1,
+                     buffer(hashlib.sha1(name).digest()), i, 0644, 0, 4,
+                     name, '', 0, 0, None))
+    db.executemany("INSERT INTO catalog VALUES (" + \
+                   ", ".join(["?"] * 15) + ");", rows)
+    db.commit()
+    db.close()
+    return path
+
+
+def literal_lookup(catalog, md5path_1, md5path_2):
+    return catalog.run_sql("SELECT " + DirectoryEntry.catalog_db_fields() + \
+                           " FROM catalog WHERE md5path_1 = " + str(md5path_1) + \
+                           " AND md5path_2 = " + str(md5path_2) + " LIMIT 1;")
+
+
+def bound_lookup(catalog, md5path_1, md5path_2):
+    return catalog.run_sql("SELECT " + DirectoryEntry.catalog_db_fields() + \
+                           " FROM catalog WHERE md5path_1 = ?" + \
+                           " AND md5path_2 = ? LIMIT 1;",
+                           (md5path_1, md5path_2))
+
+
+def main():
+    synthetic    = len(sys.argv) < 2
+    catalog_path = make_synthetic_catalog(100000) if synthetic else sys.argv[1]
+    num_lookups  = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    try:
+        catalog = Catalog.open(catalog_path)
+        keys    = catalog.run_sql("SELECT md5path_1, md5path_2 FROM catalog;")
+        sample  = [ random.choice(keys) for _ in xrange(num_lookups) ]
+
+        for name, lookup in [ ('literal SQL', literal_lookup),
+                              ('bound parameters', bound_lookup) ]:
+            seconds = min(timeit.repeat(
+                lambda: [ lookup(catalog, lo, hi) for lo, hi in sample ],
+                repeat=3, number=1))
+            print "%-18s %8.2f us/lookup" % (name,
+                                             seconds / num_lookups * 1e6)
+    finally:
+        if synthetic:
+            os.unlink(catalog_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This file is part of the CernVM File System auxiliary tools.
+
+Micro-benchmark for the construction of DirectoryEntry objects from catalog
+result rows. The slotted DirectoryEntry is compared to a replica of the former
+dict-based implementation that converted every content hash to hex eagerly.
+
+Usage: benchmark_dirent.py [NUM_ENTRIES]
+"""
+
+import hashlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cvmfs.dirent import DirectoryEntry
+
+
+class LegacyDirectoryEntry:
+    """ The former DirectoryEntry construction (instance dict, eager hex) """
+
+    def __init__(self, result_set):
+        self.md5path_1, self.md5path_2, self.parent_1, self.parent_2,    \
+        self.content_hash, self.flags, self.size, self.mode, self.mtime, \
+        self.name, self.symlink = result_set
+        if self.content_hash:
+            self.content_hash = "".join(map(lambda c: ("%0.2X" % c).lower(),
+                                            map(ord, self.content_hash)))
+        self.chunks = []
+        bit_mask     = 256 + 512 + 1024
+        right_shifts = 0
+        while bit_mask & 1 == 0:
+            bit_mask >>= 1
+            right_shifts += 1
+        hash_type = ((self.flags & (256 + 512 + 1024)) >> right_shifts) + 1
+        self.content_hash_type = hash_type if 0 < hash_type < 3 else -1
+
+
+def make_rows(num_entries):
+    return [ (i, -i, 0, 0, buffer(hashlib.sha1(str(i)).digest()), 4, i, 0644,
+              0, 'file%d' % i, '') for i in xrange(num_entries) ]
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main():
+    num_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rows = make_rows(num_entries)
+    for name, cls in [ ('dict + eager hex', LegacyDirectoryEntry),
+                       ('slots + lazy hex', DirectoryEntry) ]:
+        seconds = min(timeit.repeat(lambda: [ cls(row) for row in rows ],
+                                    repeat=3, number=1))
+        print "%-18s %6.2f us/entry %6d bytes/entry" % \
+              (name, seconds / num_entries * 1e6, instance_size(cls(rows[0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,8 +13,11 @@ from repository   import *
 from availability import *
 from cache        import *
 from fetcher      import *
+from content_index import *
+from prefetch     import *
 from _common      import _split_md5
 from _common      import _combine_md5
+from _common      import _split_md5_paths
 
 import subprocess
 import re
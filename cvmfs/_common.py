@@ -5,10 +5,14 @@ Created by René Meusel
 This file is part of the CernVM File System auxiliary tools.
 """
 
-import ctypes
+import binascii
+import hashlib
 import sqlite3
+import struct
 import subprocess
 import os
+import threading
+import urllib
 
 
 _REPO_CONFIG_PATH      = "/etc/cvmfs/repositories.d"
@@ -27,23 +31,201 @@ class CvmfsNotInstalled(Exception):
         Exception.__init__(self, "It seems that cvmfs is not installed on this machine!")
 
 
+def _sqlite_compile_options():
+    """ Compile time options of the linked SQLite library (memoized) """
+    if not hasattr(_sqlite_compile_options, 'result'):
+        db = sqlite3.connect(':memory:')
+        try:
+            options = [ row[0] for row in
+                        db.execute("PRAGMA compile_options;").fetchall() ]
+        except sqlite3.DatabaseError:
+            options = []
+        db.close()
+        _sqlite_compile_options.result = options
+    return _sqlite_compile_options.result
+
+
+def _sqlite_accepts_uris():
+    """ Checks if the linked SQLite library interprets 'file:' URI filenames
+        even without being asked to (i.e. it was built with SQLITE_USE_URI)
+    """
+    return 'USE_URI' in _sqlite_compile_options()
+
+
+def _sqlite_max_attached():
+    """ Number of databases SQLite can attach to a single connection """
+    for option in _sqlite_compile_options():
+        if option.startswith('MAX_ATTACHED='):
+            return int(option[len('MAX_ATTACHED='):])
+    return 10 # SQLite's default (SQLITE_MAX_ATTACHED)
+
+
+def _readonly_database_uri(db_path):
+    """ URI for a database file that will never change while it is open """
+    return "file:" + urllib.quote(os.path.abspath(db_path)) + \
+           "?mode=ro&immutable=1"
+
+
+def _attach_name_readonly(db_path):
+    """ File name for ATTACH DATABASE opening db_path read-only if possible
+        (URI filenames in ATTACH require SQLITE_USE_URI on Python 2)
+    """
+    if _sqlite_accepts_uris():
+        return _readonly_database_uri(db_path)
+    return db_path
+
+
+def _connect_readonly(db_path, **kwargs):
+    """ Opens an immutable database file read-only, without file locking """
+    uri = _readonly_database_uri(db_path)
+    try:
+        return sqlite3.connect(uri, uri=True, **kwargs)
+    except TypeError:
+        pass # Python 2 has no 'uri' parameter
+    if _sqlite_accepts_uris():
+        return sqlite3.connect(uri, **kwargs)
+    db_handle = sqlite3.connect(db_path, **kwargs)
+    db_handle.execute("PRAGMA query_only = ON;")
+    return db_handle
+
+
 class DatabaseObject:
-    _db_handle = None
+    """ Base class for read-only SQLite database files
+        Every thread gets its own connection to the database file. Hence,
+        independent queries from different threads run in parallel instead
+        of serializing on a single shared connection.
+        Connections and the database file are released by close(), or when
+        leaving a with-block: with Catalog.open(path) as catalog: ...
+        A cache of database objects (see Repository) might suspend() them
+        instead, they are reopened through _reopen() when used again.
+    """
+
+    # number of prepared statements kept per connection (see sqlite3.connect)
+    statement_cache_size = 256
+
+    # connection tuning, can be overridden per class or instance
+    #   mmap_size:  bytes of the database file to memory map (0 to disable)
+    #   cache_size: page cache size in pages, or in KiB if negative
+    #   temp_store: where temporary tables live (DEFAULT, FILE or MEMORY)
+    mmap_size  = 256 * 1024 * 1024
+    cache_size = -16 * 1024
+    temp_store = "MEMORY"
+
+    _closed    = False
+    _suspended = False
+
+    # called with the suspended object to provide its database file again
+    _reopen    = None
 
     def __init__(self, db_file):
-        self._file = db_file
-        self._open_database()
+        self._file            = db_file
+        self._db_handles      = {}
+        self._db_handles_lock = threading.Lock()
+        self._get_db_handle()
 
     def __del__(self):
-        if self._db_handle:
-            self._db_handle.close()
-        self._file.close()
+        if hasattr(self, '_file'):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """ Closes all database connections and the database file
+            Calling close() more than once is a no-op
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(self, '_db_handles'):
+            with self._db_handles_lock:
+                self._close_db_handles()
+        if self._file is not None:
+            self._file.close()
+
+    def suspend(self):
+        """ Releases the connections and the database file like close(), but
+            the database is reopened through _reopen() once it is used again
+            Objects used by other threads concurrently must not be suspended.
+        """
+        with self._db_handles_lock:
+            if self._closed or self._suspended:
+                return
+            self._suspended = True
+            self._close_db_handles()
+            self._file.close()
+            self._file = None
+
+    def _resume(self, db_file):
+        """ Continues a suspended object with its (reopened) database file
+            :return: False if the object is not suspended (anymore)
+        """
+        with self._db_handles_lock:
+            if self._closed or not self._suspended:
+                return False
+            self._file      = db_file
+            self._suspended = False
+            return True
+
+    def _close_db_handles(self):
+        for db_handle in self._db_handles.values():
+            db_handle.close()
+        self._db_handles.clear()
+
+    def _get_db_handle(self):
+        """ Finds (or creates) the database connection of the calling thread """
+        thread_id = threading.current_thread().ident
+        try:
+            return self._db_handles[thread_id]
+        except KeyError:
+            pass
+        while True:
+            with self._db_handles_lock:
+                if self._closed:
+                    raise sqlite3.ProgrammingError(
+                        "Cannot operate on a closed database.")
+                if not self._suspended:
+                    self._close_orphaned_handles()
+                    db_handle = self._open_database()
+                    self._db_handles[thread_id] = db_handle
+                    return db_handle
+            self._reopen(self)
+
+    def _close_orphaned_handles(self):
+        """ Closes connections of threads that do not exist anymore """
+        alive_threads = set([ t.ident for t in threading.enumerate() ])
+        for thread_id in self._db_handles.keys():
+            if thread_id not in alive_threads:
+                self._db_handles.pop(thread_id).close()
 
     def _open_database(self):
-        """ Create and configure a database handle to the Catalog """
-        self._db_handle = sqlite3.connect(self._file.name,
-                                          check_same_thread=False)
-        self._db_handle.text_factory = str
+        """ Create and configure a database handle to the Catalog
+            Downloaded objects are content addressed and never change, hence
+            they are opened read-only as immutable files (no locking, no
+            journal) and read through a memory map where possible.
+            Connections are used by a single thread at a time but might be
+            closed from a different one (check_same_thread=False).
+        """
+        db_handle = _connect_readonly(self._file.name,
+                                      check_same_thread=False,
+                                      cached_statements=self.statement_cache_size)
+        db_handle.text_factory = str
+        self._configure_database(db_handle)
+        return db_handle
+
+    def _configure_database(self, db_handle):
+        if self.temp_store.upper() not in ("DEFAULT", "FILE", "MEMORY"):
+            raise Exception("Unknown temp_store '" + self.temp_store + "'")
+        db_handle.execute("PRAGMA mmap_size = %d;"  % int(self.mmap_size))
+        db_handle.execute("PRAGMA cache_size = %d;" % int(self.cache_size))
+        db_handle.execute("PRAGMA temp_store = " + self.temp_store + ";")
 
     def db_size(self):
         return os.path.getsize(self._file.name)
@@ -56,41 +238,66 @@ class DatabaseObject:
             prop_value = prop[1]
             reader(prop_key, prop_value)
 
-    def run_sql(self, sql):
-        """ Run an arbitrary SQL query on the catalog database """
-        cursor = self._db_handle.cursor()
-        cursor.execute(sql)
+    def run_sql(self, sql, parameters = ()):
+        """ Run an arbitrary SQL query on the catalog database
+            Values should be passed as bound parameters rather than being
+            pasted into the query string. That way the compiled statement is
+            reused from the connection's statement cache on every call.
+        """
+        cursor = self._get_db_handle().cursor()
+        cursor.execute(sql, parameters)
         data = cursor.fetchall()
         cursor.close()
         return data
 
+    def run_sql_batches(self, sql, parameters = (), batch_size = 10000):
+        """ Run an SQL query and yield its result rows in lists of batch_size
+            instead of materializing the whole result at once
+        """
+        cursor = self._get_db_handle().cursor()
+        try:
+            cursor.execute(sql, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def open_interactive(self):
         """ Spawns a sqlite shell for interactive catalog database inspection """
         subprocess.call(['sqlite3', self._file.name])
 
 
 
+def _canonicalize_path(path):
+    if not path:
+        return ""
+    return os.path.abspath(path)
+
 def _binary_buffer_to_hex_string(binbuf):
-    return "".join(map(lambda c: ("%0.2X" % c).lower(),map(ord,binbuf)))
+    return binascii.hexlify(binbuf)
+
+# MD5 digests are stored in the catalogs as two signed little-endian int64
+_MD5_SPLIT   = struct.Struct('<qq')
+_MD5_COMBINE = struct.Struct('<QQ')
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
 
 def _split_md5(md5digest):
-    hi = lo = 0
-    for i in range(0, 8):
-        lo |= (ord(md5digest[i]) << (i * 8))
-    for i in range(8,16):
-        hi |= (ord(md5digest[i]) << ((i - 8) * 8))
-    return ctypes.c_int64(lo).value, ctypes.c_int64(hi).value  # signed int!
+    return _MD5_SPLIT.unpack(md5digest)  # signed int!
 
 def _combine_md5(lo, hi):
-    md5digest = [ '\x00','\x00','\x00','\x00','\x00','\x00','\x00','\x00',
-                  '\x00','\x00','\x00','\x00','\x00','\x00','\x00','\x00' ]
-    for i in range(0, 8):
-        md5digest[i] = chr(lo & 0xFF)
-        lo >>= 8
-    for i in range(8,16):
-        md5digest[i] = chr(hi & 0xFF)
-        hi >>= 8
-    return ''.join(md5digest)
+    return _MD5_COMBINE.pack(lo & _UINT64_MASK, hi & _UINT64_MASK)
+
+def _split_md5_paths(paths):
+    """ Hashes many paths and splits the MD5 digests in a single unpack call
+        :return: list of (md5path_1, md5path_2) tuples in the order of paths
+    """
+    md5 = hashlib.md5
+    digests = "".join([ md5(path).digest() for path in paths ])
+    halves  = struct.unpack("<%dq" % (len(digests) // 8), digests)
+    return zip(halves[0::2], halves[1::2])
 
 
 class TzInfos:
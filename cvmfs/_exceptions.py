@@ -64,6 +64,22 @@ class NestedCatalogNotFound(Exception):
     def __str__(self):
         return repr(self.repo)
 
+class CheckpointMismatch(Exception):
+    def __init__(self, checkpoint_file, root_hash):
+        self.checkpoint_file = checkpoint_file
+        self.root_hash       = root_hash
+
+    def __str__(self):
+        return self.checkpoint_file + " does not belong to " + self.root_hash
+
+class MergeQueryRequired(Exception):
+    def __init__(self, max_attached):
+        self.max_attached = max_attached
+
+    def __str__(self):
+        return "more than " + str(self.max_attached) + \
+               " catalogs can only be queried with a merge_sql query"
+
 class RepositoryVerificationFailed(Exception):
     def __init__(self, message, repo):
         Exception.__init__(self, message)
@@ -5,26 +5,48 @@ Created by René Meusel
 This file is part of the CernVM File System auxiliary tools.
 """
 
+import binascii
 import datetime
 import collections
 import hashlib
-import os
+import sqlite3
 
 
-from _common import _split_md5, DatabaseObject
-from dirent  import DirectoryEntry, Chunk
+from _common import _split_md5, _canonicalize_path, DatabaseObject
+from dirent  import DirectoryEntry, Chunk, ContentHashTypes, _Flags
 
 
 class CatalogIterator:
-    """ Iterates through all directory entries of a Catalog """
-
-    def __init__(self, catalog):
-        self.catalog = catalog
-        self.backlog = collections.deque()
+    """ Iterates through all directory entries of a Catalog
+        :param path:      start the traversal at this directory instead of
+                          the catalog's root
+        :param max_depth: do not descend more than max_depth directory levels
+                          below the start (0 yields the start entry only)
+        :param backlog:   resume a traversal from the pending entries saved
+                          by get_backlog() (path has to be the same)
+        :param compact:   keep pending entries as (path, md5path_1, md5path_2)
+                          and look up their DirectoryEntry once they are due,
+                          which bounds the memory used for wide directories
+    """
+
+    def __init__(self, catalog, path = None, max_depth = None, backlog = None,
+                 compact = False):
+        self.catalog   = catalog
+        self.backlog   = collections.deque()
+        self.max_depth = max_depth
+        self.compact   = compact
         root_path = ""
-        if not self.catalog.is_root():
+        if path is not None:
+            root_path = path if path != "/" else ""
+        elif not self.catalog.is_root():
             root_path = self.catalog.root_prefix
-        self._push((root_path, self.catalog.find_directory_entry(root_path)))
+        self._base_depth = root_path.count('/')
+        if backlog is not None:
+            self._restore_backlog(backlog)
+            return
+        root_dirent = self.catalog.find_directory_entry(root_path)
+        if root_dirent is not None:
+            self._push_dirent(root_path, root_dirent)
 
 
     def __iter__(self):
@@ -37,6 +59,24 @@ class CatalogIterator:
         return self._recursion_step()
 
 
+    def get_backlog(self):
+        """ The entries still to be yielded as (path, md5path_1, md5path_2) """
+        if self.compact:
+            return list(self.backlog)
+        return [ (path, dirent.md5path_1, dirent.md5path_2)
+                 for path, dirent in self.backlog ]
+
+
+    def _restore_backlog(self, backlog):
+        if self.compact:
+            self.backlog.extend(backlog)
+            return
+        dirents = self.catalog.find_directory_entries_split_md5(
+            [ (md5path_1, md5path_2) for _, md5path_1, md5path_2 in backlog ])
+        for path, md5path_1, md5path_2 in backlog:
+            self._push((path, dirents[(md5path_1, md5path_2)]))
+
+
     def _has_more(self):
         return len(self.backlog) > 0
 
@@ -45,20 +85,50 @@ class CatalogIterator:
         self.backlog.append(path)
 
 
+    def _push_dirent(self, path, dirent):
+        if self.compact:
+            self._push((path, dirent.md5path_1, dirent.md5path_2))
+        else:
+            self._push((path, dirent))
+
+
     def _pop(self):
-        return self.backlog.pop()
+        if not self.compact:
+            return self.backlog.pop()
+        path, md5path_1, md5path_2 = self.backlog.pop()
+        return path, self.catalog.find_directory_entry_split_md5(md5path_1,
+                                                                 md5path_2)
 
 
     def _recursion_step(self):
         path, dirent = self._pop()
-        if dirent.is_directory():
-            new_dirents = self.catalog.list_directory_split_md5(dirent.md5path_1, \
-                                                                dirent.md5path_2)
-            for new_dirent in new_dirents:
-                self._push((path + "/" + new_dirent.name, new_dirent))
+        if dirent.is_directory() and self._may_descend(path):
+            if self.compact:
+                self._push_listing_md5paths(path, dirent)
+            else:
+                self._push_listing(path, dirent)
         return path, dirent
 
 
+    def _push_listing(self, path, dirent):
+        new_dirents = self.catalog.list_directory_split_md5(dirent.md5path_1, \
+                                                            dirent.md5path_2)
+        for new_dirent in new_dirents:
+            self._push((path + "/" + new_dirent.name, new_dirent))
+
+
+    def _push_listing_md5paths(self, path, dirent):
+        listing = self.catalog.list_directory_md5paths_split_md5(dirent.md5path_1,
+                                                                 dirent.md5path_2)
+        for md5path_1, md5path_2, name in listing:
+            self._push((path + "/" + name, md5path_1, md5path_2))
+
+
+    def _may_descend(self, path):
+        return self.max_depth is None or \
+               path.count('/') - self._base_depth < self.max_depth
+
+
 
 class CatalogReference:
     """ Wraps a catalog reference to nested catalogs as found in Catalogs """
@@ -79,13 +149,55 @@ class CatalogReference:
 
 
 
-class CatalogStatistics:
-    """ Provides a convenience data wrapper around catalog statistics """
+class CatalogReferenceFilters:
+    """ Predicates on CatalogReferences (root_path, hash, size) that prune a
+        catalog traversal before the referenced catalogs are downloaded (see
+        the reference_filter of RevisionIterator and CatalogTreeIterator)
+    """
+
+    @staticmethod
+    def path_prefix(prefix):
+        """ Keeps catalogs below prefix and those on the way to it """
+        prefix = _canonicalize_path(prefix).rstrip('/')
+        return lambda ref: ref.root_path == prefix                  or \
+                           ref.root_path.startswith(prefix + '/')   or \
+                           prefix.startswith(ref.root_path + '/')
+
+    @staticmethod
+    def max_depth(depth):
+        """ Keeps catalogs mounted at most depth directory levels deep """
+        return lambda ref: ref.root_path.count('/') <= depth
 
-    def __init__(self, catalog):
+    @staticmethod
+    def max_size(size):
+        """ Keeps catalogs of at most size bytes (or of unknown size) """
+        return lambda ref: ref.size <= size
+
+    @staticmethod
+    def all_of(*predicates):
+        return lambda ref: all(predicate(ref) for predicate in predicates)
+
+
+
+class CatalogStatistics:
+    """ Provides a convenience data wrapper around catalog statistics
+        Catalogs older than schema 2.1 lack a statistics table. For them (or
+        if computed is set) the catalog's own counters are derived from its
+        content instead. Subtree counters of such catalogs are provided by
+        Repository.get_subtree_statistics().
+    """
+
+    # counters provided for the catalog itself and (prefixed by 'all_') for
+    # the catalog including its nested catalog subtree
+    counters = [ 'regular', 'dir', 'symlink', 'file_size',
+                 'chunked', 'chunked_size', 'chunks', 'nested' ]
+
+    def __init__(self, catalog, computed = False):
         self.catalog = catalog
-        if catalog.schema >= 2.1:
+        if catalog.schema >= 2.1 and not computed:
             self._read_statistics(catalog)
+        else:
+            self._compute_statistics(catalog)
 
     def __str__(self):
         return "<CatalogStatistics for " + self.catalog.root_prefix + ">"
@@ -138,6 +250,36 @@ class CatalogStatistics:
                 setattr(self, "all_" + stat[8:], value + getattr(self, stat[8:]))
 
 
+    def has_subtree_statistics(self):
+        return all(hasattr(self, 'all_' + counter) for counter in self.counters)
+
+    def _compute_statistics(self, catalog):
+        """ Derives the catalog's own counters with a single aggregate query """
+        chunks = "(SELECT count(*) FROM chunks)" if catalog.schema >= 2.4 \
+                 else "0"
+        values = catalog.run_sql("SELECT                                     \
+            coalesce(sum((flags & ?) != 0), 0),                             \
+            coalesce(sum((flags & ?) != 0), 0),                             \
+            coalesce(sum((flags & ?) != 0), 0),                             \
+            coalesce(sum(CASE WHEN flags & ? THEN size ELSE 0 END), 0),     \
+            coalesce(sum((flags & ?) != 0), 0),                             \
+            coalesce(sum(CASE WHEN flags & ? THEN size ELSE 0 END), 0),     \
+            " + chunks + ",                                                 \
+            (SELECT count(*) FROM nested_catalogs)                          \
+            FROM catalog;", (_Flags.File,      _Flags.Directory,
+                             _Flags.Link,      _Flags.File,
+                             _Flags.FileChunk, _Flags.FileChunk))[0]
+        for counter, value in zip(self.counters, values):
+            setattr(self, counter, value)
+
+    def _set_subtree_statistics(self, nested_statistics):
+        """ Sums up the subtree counters from the nested catalogs' ones """
+        for counter in self.counters:
+            setattr(self, 'all_' + counter,
+                    getattr(self, counter) +
+                    sum(nested._get_stat('all_' + counter)
+                        for nested in nested_statistics))
+
     def _get_stat(self, stat):
         if not hasattr(self, stat):
             raise Exception("Statistic '" + stat + "' not provided.")
@@ -145,9 +287,46 @@ class CatalogStatistics:
 
 
 
+class ContentHashIndex(DatabaseObject):
+    """ On-disk index of the content hashes (bulk and chunks) in a Catalog """
+
+    @staticmethod
+    def build(catalog, index_path):
+        """ Creates the index database for a given catalog in index_path """
+        db = sqlite3.connect(index_path)
+        db.execute("CREATE TABLE content_hashes (hash BLOB, md5path_1 INTEGER, \
+                                                 md5path_2 INTEGER,            \
+                                                 flags INTEGER);")
+        db.execute("ATTACH DATABASE ? AS clg;", (catalog._file.name,))
+        db.execute("INSERT INTO content_hashes                     \
+                    SELECT hash, md5path_1, md5path_2, flags       \
+                    FROM clg.catalog WHERE hash IS NOT NULL;")
+        if catalog.schema >= 2.4:
+            db.execute("INSERT INTO content_hashes                 \
+                        SELECT chunks.hash, chunks.md5path_1,      \
+                               chunks.md5path_2, catalog.flags     \
+                        FROM clg.chunks AS chunks                  \
+                        JOIN clg.catalog AS catalog                \
+                        ON chunks.md5path_1 = catalog.md5path_1 AND \
+                           chunks.md5path_2 = catalog.md5path_2;")
+        db.execute("CREATE INDEX idx_content_hashes ON content_hashes (hash);")
+        db.commit()
+        db.execute("DETACH DATABASE clg;")
+        db.close()
+
+    def find(self, hash_blob):
+        """ Finds (md5path_1, md5path_2, flags) of entries using hash_blob """
+        return self.run_sql("SELECT md5path_1, md5path_2, flags \
+                             FROM content_hashes                \
+                             WHERE hash = ?;", (hash_blob,))
+
+
 class Catalog(DatabaseObject):
     """ Wraps the basic functionality of CernVM-FS Catalogs """
 
+    # number of bound parameters in set-based lookups (SQLite allows >= 999)
+    _lookup_batch_size = 500
+
     @staticmethod
     def open(catalog_path):
         """ Initializes a Catalog from a local file path """
@@ -157,6 +336,8 @@ class Catalog(DatabaseObject):
     def __init__(self, catalog_file, catalog_hash = ""):
         DatabaseObject.__init__(self, catalog_file)
         self.hash = catalog_hash
+        self._nested_references = None
+        self._nested_index      = None
         self._read_properties()
         self._guess_root_prefix_if_needed()
         self._guess_last_modified_if_needed()
@@ -181,51 +362,107 @@ class Catalog(DatabaseObject):
 
     def nested_count(self):
         """ Returns the number of nested catalogs in this catalog """
-        num_catalogs = self.run_sql("SELECT count(*) FROM nested_catalogs;")
-        return num_catalogs[0][0]
+        return len(self._get_nested_references())
 
 
     def list_nested(self):
         """ List CatalogReferences to all contained nested catalogs """
-        new_version = (self.schema <= 1.2 and self.schema_revision > 0)
+        return list(self._get_nested_references())
+
+
+    def _get_nested_references(self):
+        """ Reads the nested catalog references once (catalogs are immutable) """
+        if self._nested_references is not None:
+            return self._nested_references
+        # the nested catalog size was introduced with schema 2.5 revision 1
+        new_version = (self.schema >= 2.5 and self.schema_revision > 0)
         if new_version:
             sql_query = "SELECT path, sha1, size FROM nested_catalogs;"
         else:
             sql_query = "SELECT path, sha1 FROM nested_catalogs;"
         catalogs = self.run_sql(sql_query)
         if new_version:
-            return [ CatalogReference(clg[0], clg[1], clg[2]) for clg in catalogs ]
+            self._nested_references = \
+                [ CatalogReference(clg[0], clg[1], clg[2]) for clg in catalogs ]
         else:
-            return [ CatalogReference(clg[0], clg[1]) for clg in catalogs ]
-
-
-    def get_statistics(self):
-        """ returns the embedded catalog statistics (if available) """
-        return CatalogStatistics(self)
-
-    def _path_sanitized(self, needle_path, nested_path):
-        """
-        Checks if one of the siblings of the path is a nested catalog and
-        contains the same initial characters
+            self._nested_references = \
+                [ CatalogReference(clg[0], clg[1]) for clg in catalogs ]
+        return self._nested_references
+
+
+    def _get_nested_index(self):
+        """ Maps the mountpoints of all nested catalogs to their references """
+        if self._nested_index is None:
+            self._nested_index = dict([ (ref.root_path, ref)
+                                        for ref in self._get_nested_references() ])
+        return self._nested_index
+
+
+    def export_columns(self, exclude_nested_root = False, batch_size = 65536):
+        """ Exports the metadata of all directory entries as NumPy arrays
+            Rows are copied from the SQL result in batches straight into
+            preallocated arrays, without creating any DirectoryEntry objects.
+            :param exclude_nested_root: skip the root entry of nested catalogs
+                                        (it is a duplicate of the mountpoint)
+            :return: dict of equally long int64 arrays: md5path_1, md5path_2,
+                     parent_1, parent_2, size, mode, mtime, flags, hash_type
+                     and chunks (number of file chunks)
         """
-        return len(needle_path) == len(nested_path) or \
-            (len(needle_path) > len(nested_path) and
-                needle_path[len(nested_path)] == '/')
+        import numpy
+        columns = [ 'md5path_1', 'md5path_2', 'parent_1', 'parent_2',
+                    'size', 'mode', 'mtime', 'flags', 'chunks' ]
+        where_clause = ""
+        if exclude_nested_root:
+            where_clause = " WHERE flags & %d = 0" % _Flags.NestedCatalogRoot
+        if self.schema >= 2.4:
+            chunk_count = "CASE WHEN flags & %d THEN                           \
+                             (SELECT count(*) FROM chunks                      \
+                              WHERE chunks.md5path_1 = catalog.md5path_1 AND   \
+                                    chunks.md5path_2 = catalog.md5path_2)      \
+                           ELSE 0 END" % _Flags.FileChunk
+        else:
+            chunk_count = "0"
+        num_rows = self.run_sql("SELECT count(*) FROM catalog" +
+                                where_clause + ";")[0][0]
+        data = numpy.empty((num_rows, len(columns)), dtype=numpy.int64)
+        position = 0
+        for rows in self.run_sql_batches("SELECT md5path_1, md5path_2,         \
+                                            parent_1, parent_2,                \
+                                            coalesce(size, 0),                 \
+                                            coalesce(mode, 0),                 \
+                                            coalesce(mtime, 0), flags, " +
+                                            chunk_count + " FROM catalog" +
+                                            where_clause + ";",
+                                         batch_size=batch_size):
+            data[position:position + len(rows)] = rows
+            position += len(rows)
+        arrays = dict([ (name, numpy.ascontiguousarray(data[:, i]))
+                        for i, name in enumerate(columns) ])
+        # there are only a handful of distinct flag values to decode
+        flag_values, inverse = numpy.unique(arrays['flags'], return_inverse=True)
+        hash_types = numpy.array([ ContentHashTypes.from_flags(flags)
+                                   for flags in flag_values ], dtype=numpy.int64)
+        arrays['hash_type'] = hash_types[inverse]
+        return arrays
+
+    def get_statistics(self, computed = False):
+        """ returns the embedded catalog statistics (computed if unavailable) """
+        return CatalogStatistics(self, computed)
 
     def find_nested_for_path(self, needle_path):
-        """ Find the best matching nested CatalogReference for a given path """
-        nested_catalogs  = self.list_nested()
-        best_match       = None
-        best_match_score = 0
+        """ Find the best matching nested CatalogReference for a given path
+            The path itself and its parent directories are the only possible
+            mountpoints, hence the lookup costs one probe per path element.
+        """
+        nested_index = self._get_nested_index()
+        if not nested_index:
+            return None
         real_needle_path = self._canonicalize_path(needle_path)
-        for nested_catalog in nested_catalogs:
-            if real_needle_path.startswith(nested_catalog.root_path) and    \
-               len(nested_catalog.root_path) > best_match_score and         \
-                self._path_sanitized(real_needle_path,
-                                     nested_catalog.root_path):
-                    best_match_score = len(nested_catalog.root_path)
-                    best_match       = nested_catalog
-        return best_match
+        while len(real_needle_path) > 1:
+            if real_needle_path in nested_index:
+                return nested_index[real_needle_path]
+            real_needle_path = real_needle_path[:real_needle_path.rfind('/')]
+        return None
 
 
     def list_directory(self, path):
@@ -241,13 +478,19 @@ class Catalog(DatabaseObject):
         """ Create a directory listing of DirectoryEntry items based on MD5 path """
         res = self.run_sql("SELECT " + DirectoryEntry.catalog_db_fields() + " \
                             FROM catalog                                       \
-                            WHERE parent_1 = " + str(parent_1) + " AND         \
-                                  parent_2 = " + str(parent_2) + "             \
-                            ORDER BY name ASC;")
+                            WHERE parent_1 = ? AND parent_2 = ?                \
+                            ORDER BY name ASC;", (parent_1, parent_2))
         for result in res:
             yield self._make_directory_entry(result)
 
 
+    def list_directory_md5paths_split_md5(self, parent_1, parent_2):
+        """ Lists a directory as (md5path_1, md5path_2, name) tuples only """
+        return self.run_sql("SELECT md5path_1, md5path_2, name FROM catalog \
+                             WHERE parent_1 = ? AND parent_2 = ?          \
+                             ORDER BY name ASC;", (parent_1, parent_2))
+
+
     def find_directory_entry(self, path):
         """ Finds the DirectoryEntry for a given path """
         real_path = self._canonicalize_path(path)
@@ -265,51 +508,142 @@ class Catalog(DatabaseObject):
         """ Finds the DirectoryEntry for the given split MD5 hashed path """
         res = self.run_sql("SELECT " + DirectoryEntry.catalog_db_fields() + " \
                             FROM catalog                                      \
-                            WHERE md5path_1 = " + str(md5path_1) + " AND      \
-                                  md5path_2 = " + str(md5path_2) + "          \
-                            LIMIT 1;")
+                            WHERE md5path_1 = ? AND md5path_2 = ?             \
+                            LIMIT 1;", (md5path_1, md5path_2))
         return self._make_directory_entry(res[0]) if len(res) == 1 else None
 
+    def find_directory_entries_split_md5(self, md5paths):
+        """ Finds the DirectoryEntries for many split MD5 hashed paths at once
+            The hashes are looked up in chunks with a set-based query that uses
+            the catalog's primary key index.
+            :param md5paths: iterable of (md5path_1, md5path_2) tuples
+            :return: a dict mapping the found md5path tuples to DirectoryEntry
+        """
+        dirents = {}
+        for result in self._select_by_md5paths(DirectoryEntry.catalog_db_fields(),
+                                               md5paths):
+            dirents[(result[0], result[1])] = self._make_directory_entry(result)
+        return dirents
+
+    def _select_by_md5paths(self, fields, md5paths):
+        """ Yields the catalog rows (fields must start with the md5path columns)
+            of all given md5path tuples in chunked 'IN' queries
+        """
+        wanted     = set(md5paths)
+        md5path_1s = list(set([ md5path_1 for md5path_1, _ in wanted ]))
+        batch_size = Catalog._lookup_batch_size
+        sql_query  = "SELECT " + fields + " FROM catalog \
+                      WHERE md5path_1 IN (" + ",".join(["?"] * batch_size) + ");"
+        for i in range(0, len(md5path_1s), batch_size):
+            batch = md5path_1s[i:i + batch_size]
+            # pad the batch to keep the statement text (and its cache entry) fixed
+            batch.extend([ batch[-1] ] * (batch_size - len(batch)))
+            for result in self.run_sql(sql_query, batch):
+                if (result[0], result[1]) in wanted:
+                    yield result
+
     def backtrace_path_split_md5(self, md5path_1, md5path_2):
         """ finds the file path associated with a given MD5 hash """
+        path_cache = { self._root_md5path(): self.root_prefix }
+        return self._backtrace_ancestors((md5path_1, md5path_2), path_cache)
+
+    def backtrace_paths_split_md5(self, md5paths, path_cache = None):
+        """ finds the file paths associated with many given MD5 hashes
+            Parent directories are resolved once and memoized in path_cache,
+            which can be shared between calls (even for different catalogs)
+            :param md5paths: iterable of (md5path_1, md5path_2) tuples
+            :param path_cache: optional dict mapping md5path tuples to paths
+            :return: list of paths (None if not found) in the input order
+        """
+        if path_cache is None:
+            path_cache = {}
+        path_cache[self._root_md5path()] = self.root_prefix
+        md5paths = list(md5paths)
+        unknown  = [ md5path for md5path in md5paths
+                     if md5path not in path_cache ]
+        for md5path_1, md5path_2, parent_1, parent_2, name in \
+                self._select_by_md5paths("md5path_1, md5path_2, \
+                                          parent_1, parent_2, name", unknown):
+            parent_md5path = (parent_1, parent_2)
+            if parent_md5path in path_cache:
+                parent_path = path_cache[parent_md5path]
+            else:
+                parent_path = self._backtrace_ancestors(parent_md5path,
+                                                        path_cache)
+            if parent_path is not None:
+                path_cache[(md5path_1, md5path_2)] = \
+                    self._join_path(parent_path, name)
+        return [ path_cache.get(md5path) for md5path in md5paths ]
+
+    def _backtrace_ancestors(self, md5path, path_cache):
+        """ Reconstructs a path and the paths of all of its parent directories
+            up to the catalog root in a single recursive query
+        """
+        root_md5path = self._root_md5path()
+        ancestors = self.run_sql("WITH RECURSIVE                                \
+            ancestors(md5path_1, md5path_2, parent_1, parent_2, name, depth) AS \
+              (SELECT md5path_1, md5path_2, parent_1, parent_2, name, 0         \
+               FROM catalog WHERE md5path_1 = ? AND md5path_2 = ?               \
+               UNION ALL                                                        \
+               SELECT catalog.md5path_1, catalog.md5path_2, catalog.parent_1,   \
+                      catalog.parent_2, catalog.name, ancestors.depth + 1       \
+               FROM catalog JOIN ancestors                                      \
+               ON catalog.md5path_1 = ancestors.parent_1 AND                    \
+                  catalog.md5path_2 = ancestors.parent_2                        \
+               WHERE NOT (ancestors.md5path_1 = ? AND ancestors.md5path_2 = ?)) \
+            SELECT md5path_1, md5path_2, name FROM ancestors                    \
+            ORDER BY depth DESC;", md5path + root_md5path)
+        if not ancestors or (ancestors[0][0], ancestors[0][1]) != root_md5path:
+            return None
+        path = self.root_prefix
+        for md5path_1, md5path_2, name in ancestors[1:]:
+            path = self._join_path(path, name)
+            path_cache[(md5path_1, md5path_2)] = path
+        return path
+
+    def _root_md5path(self):
         catalog_root_path = self.root_prefix if self.root_prefix != "/" else ""
-        root_md5_hash     = _split_md5(hashlib.md5(catalog_root_path).digest())
-        result = ""
-        while True:
-            res = self.run_sql("SELECT parent_1, parent_2, name          \
-                                FROM catalog                             \
-                                WHERE md5path_1 = " + str(md5path_1) + " \
-                                  AND md5path_2 = " + str(md5path_2) + ";")
-            if len(res) != 1:
-                break
-
-            md5parent_1, md5parent_2 = res[0][0], res[0][1]
-            if md5parent_1 == root_md5_hash[0] and \
-               md5parent_2 == root_md5_hash[1]:
-                break
-
-            result = res[0][2] + ("/" + result if result != "" else "")
-            md5path_1 = md5parent_1
-            md5path_2 = md5parent_2
-        return self.root_prefix + result if result != "" else None
-
-    def backtrace_content_hash(self, content_hash):
-        """ Try to find file paths that reference a given content hash """
-        # TODO(rmeusel): currently this only works for SHA-1 content hashes
-        bulk_chunks = self.run_sql("SELECT md5path_1, md5path_2 \
-                                    FROM catalog                \
-                                    WHERE lower(hex(hash)) = '" +
-                                                            content_hash + "';")
-        partial_chunks = self.run_sql("SELECT md5path_1, md5path_2 \
-                                       FROM chunks                 \
-                                       WHERE lower(hex(hash)) = '" +
-                                                            content_hash + "';")
-        pairs = []
-        for md5pair in bulk_chunks + partial_chunks:
-            pairs.append(self.backtrace_path_split_md5(md5pair[0], md5pair[1]))
-
-        return pairs
+        return _split_md5(hashlib.md5(catalog_root_path).digest())
 
+    @staticmethod
+    def _join_path(parent_path, name):
+        return (parent_path if parent_path != "/" else "") + "/" + name
+
+    def backtrace_content_hash(self, content_hash, hash_index = None):
+        """ Try to find file paths that reference a given content hash
+            :param content_hash: hex string of a SHA-1 or RIPEMD-160 hash as
+                                 found in the CAS (e.g. '<hex digest>-rmd160')
+            :param hash_index: optional ContentHashIndex of this catalog
+        """
+        hex_digest, hash_type = \
+            ContentHashTypes.from_suffixed_hash(content_hash.lower())
+        hash_blob = buffer(binascii.unhexlify(hex_digest))
+        if hash_index:
+            matches = hash_index.find(hash_blob)
+        else:
+            matches = self._find_content_hash(hash_blob)
+        return self.backtrace_paths_split_md5(
+                    [ (md5path_1, md5path_2)
+                      for md5path_1, md5path_2, flags in matches
+                      if ContentHashTypes.from_flags(flags) == hash_type ])
+
+    def _find_content_hash(self, hash_blob):
+        """ Compares binary hashes instead of hex strings (no per-row hex()) """
+        bulk_chunks = self.run_sql("SELECT md5path_1, md5path_2, flags \
+                                    FROM catalog                       \
+                                    WHERE hash = ?;", (hash_blob,))
+        if self.schema < 2.4:
+            return bulk_chunks
+        partial_chunks = self.run_sql("SELECT chunks.md5path_1,           \
+                                              chunks.md5path_2,           \
+                                              catalog.flags               \
+                                       FROM chunks JOIN catalog           \
+                                       ON chunks.md5path_1 =              \
+                                            catalog.md5path_1 AND         \
+                                          chunks.md5path_2 =              \
+                                            catalog.md5path_2             \
+                                       WHERE chunks.hash = ?;", (hash_blob,))
+        return bulk_chunks + partial_chunks
 
     def is_root(self):
         """ Checks if this is the root catalog (based on the root prefix) """
@@ -356,13 +690,13 @@ class Catalog(DatabaseObject):
 
     def _read_chunks(self, dirent):
         """ Finds and adds the file chunk of a DirectoryEntry """
-        if self.schema < 2.4:
+        if self.schema < 2.4 or not dirent.flags & _Flags.FileChunk:
             return
         res = self.run_sql("SELECT " + Chunk.catalog_db_fields() + "            \
                             FROM chunks                                         \
-                            WHERE md5path_1 = " + str(dirent.md5path_1) + " AND \
-                                  md5path_2 = " + str(dirent.md5path_2) + "     \
-                            ORDER BY offset ASC;")
+                            WHERE md5path_1 = ? AND md5path_2 = ?               \
+                            ORDER BY offset ASC;", (dirent.md5path_1,
+                                                    dirent.md5path_2))
         dirent._add_chunks(res)
 
 
@@ -383,21 +717,12 @@ class Catalog(DatabaseObject):
         :param path: path to find
         :return: the closest catalog-child to a given path
         """
-        max_length = 0
-        best_fit = None
-        for cr in self.list_nested():
-            curr_length = path.find(cr.root_path)
-            if curr_length == 0 and len(cr.root_path) > max_length:
-                best_fit = cr
-                max_length = len(cr.root_path)
-        return best_fit
+        return self.find_nested_for_path(path)
 
 
     @staticmethod
     def _canonicalize_path(path):
-        if not path:
-            return ""
-        return os.path.abspath(path)
+        return _canonicalize_path(path)
 
 
     def _check_validity(self):
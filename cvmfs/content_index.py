@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This file is part of the CernVM File System auxiliary tools.
+
+A content index maps the content hashes found in the catalogs of one or more
+repository revisions back to the files (and file chunks) using them. It is
+stored as an SQLite database with a B-tree index on the content hash.
+
+Catalogs are indexed by their hash. Hence, a catalog shared by many revisions
+is read only once and the nested catalogs of an already indexed catalog are
+found in the index itself without downloading anything.
+"""
+
+import binascii
+import sqlite3
+
+from dirent import ContentHashTypes
+
+
+class RepositoryContentIndex:
+    """ Persistent reverse index from content hashes to repository paths """
+    _db = None
+
+    def __init__(self, index_path):
+        self._db = sqlite3.connect(index_path)
+        self._db.text_factory = str
+        self._create_schema()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def _create_schema(self):
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS catalogs (hash TEXT, root_prefix TEXT,
+                CONSTRAINT pk_catalogs PRIMARY KEY (hash));
+            CREATE TABLE IF NOT EXISTS nested_catalogs (parent TEXT, hash TEXT);
+            CREATE TABLE IF NOT EXISTS revisions (revision INTEGER,
+                                                  catalog TEXT,
+                CONSTRAINT pk_revisions PRIMARY KEY (revision, catalog));
+            CREATE TABLE IF NOT EXISTS content_hashes (hash BLOB,
+                                                       hash_type INTEGER,
+                                                       offset INTEGER,
+                                                       path TEXT,
+                                                       catalog TEXT);
+            CREATE INDEX IF NOT EXISTS idx_nested_catalogs
+                ON nested_catalogs (parent);
+            CREATE INDEX IF NOT EXISTS idx_revisions_catalog
+                ON revisions (catalog);
+            CREATE INDEX IF NOT EXISTS idx_content_hashes
+                ON content_hashes (hash);
+        """)
+        self._db.commit()
+
+    def add_revision(self, revision):
+        """ Indexes all catalogs of a revision not found in the index yet """
+        catalog_hashes = [ revision.root_hash ]
+        while catalog_hashes:
+            catalog_hash = catalog_hashes.pop()
+            self._db.execute("INSERT OR IGNORE INTO revisions VALUES (?, ?);",
+                             (revision.revision_number, catalog_hash))
+            nested_hashes = self._find_indexed_nested(catalog_hash)
+            if nested_hashes is None:
+                catalog = revision.retrieve_catalog(catalog_hash)
+                nested_hashes = self._add_catalog(catalog)
+            catalog_hashes.extend(nested_hashes)
+        self._db.commit()
+
+    def has_catalog(self, catalog_hash):
+        return self._find_indexed_nested(catalog_hash) is not None
+
+    def find(self, content_hash):
+        """ Finds all usages of a content hash (see ContentHashTypes)
+            :return: list of (chunk offset, path, revision number) tuples,
+                     the offset is None for whole-file content hashes
+        """
+        hex_digest, hash_type = \
+            ContentHashTypes.from_suffixed_hash(content_hash.lower())
+        return self._db.execute("SELECT content_hashes.offset,               \
+                                        content_hashes.path,                 \
+                                        revisions.revision                   \
+                                 FROM content_hashes JOIN revisions          \
+                                 ON content_hashes.catalog = revisions.catalog \
+                                 WHERE content_hashes.hash = ?               \
+                                   AND content_hashes.hash_type = ?          \
+                                 ORDER BY revisions.revision,                \
+                                          content_hashes.path,               \
+                                          content_hashes.offset;",
+                                (buffer(binascii.unhexlify(hex_digest)),
+                                 hash_type)).fetchall()
+
+    def _find_indexed_nested(self, catalog_hash):
+        """ Nested catalog hashes of an indexed catalog (None if unknown) """
+        res = self._db.execute("SELECT count(*) FROM catalogs WHERE hash = ?;",
+                               (catalog_hash,)).fetchall()
+        if res[0][0] == 0:
+            return None
+        res = self._db.execute("SELECT hash FROM nested_catalogs \
+                                WHERE parent = ?;", (catalog_hash,)).fetchall()
+        return [ row[0] for row in res ]
+
+    def _add_catalog(self, catalog):
+        """ Streams all content hashes of a catalog into the index """
+        self._db.executemany("INSERT INTO content_hashes VALUES (?, ?, ?, ?, ?);",
+                             self._catalog_rows(catalog))
+        nested_hashes = [ ref.hash for ref in catalog.list_nested() ]
+        self._db.executemany("INSERT INTO nested_catalogs VALUES (?, ?);",
+                             [ (catalog.hash, nested_hash)
+                               for nested_hash in nested_hashes ])
+        # the catalog counts as indexed only once all of its rows are committed
+        self._db.execute("INSERT INTO catalogs VALUES (?, ?);",
+                         (catalog.hash, catalog.root_prefix))
+        self._db.commit()
+        return nested_hashes
+
+    @staticmethod
+    def _catalog_rows(catalog):
+        for path, dirent in catalog:
+            if not dirent.content_hash_digest:
+                continue
+            hash_type = dirent.content_hash_type
+            yield (buffer(dirent.content_hash_digest), hash_type,
+                   None, path, catalog.hash)
+            for chunk in dirent.chunks:
+                yield (buffer(chunk.content_hash), hash_type, chunk.offset,
+                       path, catalog.hash)
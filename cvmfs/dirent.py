@@ -5,7 +5,7 @@ Created by René Meusel
 This file is part of the CernVM File System auxiliary tools.
 """
 
-from _common import _binary_buffer_to_hex_string
+import binascii
 
 
 class _Flags:
@@ -19,6 +19,11 @@ class _Flags:
     FileChunk               = 64
     ContentHashType         = 256 + 512 + 1024
 
+# number of right shifts moving _Flags.ContentHashType to the lowest bits
+_CONTENT_HASH_TYPE_SHIFT = 0
+while (_Flags.ContentHashType >> _CONTENT_HASH_TYPE_SHIFT) & 1 == 0:
+    _CONTENT_HASH_TYPE_SHIFT += 1
+
 
 class ContentHashTypes:
     """ Enumeration of supported content hash types (see cvmfs/hash.h) """
@@ -36,6 +41,20 @@ class ContentHashTypes:
         else:
             return ""
 
+    @staticmethod
+    def from_suffixed_hash(content_hash_string):
+        """ splits a CAS hash string (see to_suffix) into hex digest and type """
+        if content_hash_string.endswith("-rmd160"):
+            return content_hash_string[:-7], ContentHashTypes.Ripemd160
+        else:
+            return content_hash_string, ContentHashTypes.Sha1
+
+    @staticmethod
+    def from_flags(flags):
+        """ decodes the content hash type stored in the dirent flags """
+        return _CONTENT_HASH_TYPES[(flags & _Flags.ContentHashType) >>
+                                   _CONTENT_HASH_TYPE_SHIFT]
+
     @staticmethod
     def to_string(hash_type):
         if hash_type == -1:
@@ -48,8 +67,16 @@ class ContentHashTypes:
             return 'UpperBound'
 
 
-class Chunk:
+# content hash type for every possible value of the _Flags.ContentHashType bits
+_CONTENT_HASH_TYPES = [ bits + 1 if 0 < bits + 1 < ContentHashTypes.UpperBound
+                                 else ContentHashTypes.Unknown
+                        for bits in range((_Flags.ContentHashType >>
+                                           _CONTENT_HASH_TYPE_SHIFT) + 1) ]
+
+
+class Chunk(object):
     """ Wrapper around file chunks in the CVMFS catalogs """
+    __slots__ = ('offset', 'size', 'content_hash', 'content_hash_type')
 
     def __init__(self, chunk_data, content_hash_type):
         if len(chunk_data) != 5:
@@ -65,27 +92,41 @@ class Chunk:
 
     def content_hash_string(self):
         suffix = ContentHashTypes.to_suffix(self.content_hash_type)
-        return _binary_buffer_to_hex_string(self.content_hash) + suffix
+        return binascii.hexlify(self.content_hash) + suffix
 
     @staticmethod
     def catalog_db_fields():
         return "md5path_1, md5path_2, offset, size, hash"
 
 
-class DirectoryEntry:
-    """ Thin wrapper around a DirectoryEntry as it is saved in the Catalogs """
+class DirectoryEntry(object):
+    """ Thin wrapper around a DirectoryEntry as it is saved in the Catalogs
+        Entries are created for every row of a catalog traversal, hence they
+        are slotted and convert their content hash to hex only on demand.
+    """
+    __slots__ = ('md5path_1', 'md5path_2', 'parent_1', 'parent_2',
+                 'content_hash_digest', '_content_hash', 'flags', 'size',
+                 'mode', 'mtime', 'name', 'symlink', 'chunks',
+                 'content_hash_type')
 
     def __init__(self, result_set):
         # see DirectoryEntry._catalog_db_fields()
         if len(result_set) != 11:
             raise Exception("Result set doesn't match")
         self.md5path_1, self.md5path_2, self.parent_1, self.parent_2,    \
-        self.content_hash, self.flags, self.size, self.mode, self.mtime, \
-        self.name, self.symlink = result_set
-        if self.content_hash:
-            self.content_hash = _binary_buffer_to_hex_string(self.content_hash)
-        self.chunks = []
-        self._read_content_hash_type()
+        self.content_hash_digest, self.flags, self.size, self.mode,      \
+        self.mtime, self.name, self.symlink = result_set
+        self._content_hash = None
+        self.chunks = ()
+        self.content_hash_type = _CONTENT_HASH_TYPES[
+            (self.flags & _Flags.ContentHashType) >> _CONTENT_HASH_TYPE_SHIFT]
+
+    @property
+    def content_hash(self):
+        """ hex string of the (binary) content hash or None if there is none """
+        if self._content_hash is None and self.content_hash_digest:
+            self._content_hash = binascii.hexlify(self.content_hash_digest)
+        return self._content_hash
 
     def __str__(self):
         return "<DirectoryEntry for '" + self.name + "'>"
@@ -130,7 +171,7 @@ class DirectoryEntry:
 
     def content_hash_string(self):
         suffix = ContentHashTypes.to_suffix(self.content_hash_type)
-        return _binary_buffer_to_hex_string(self.content_hash) + suffix
+        return self.content_hash + suffix
 
     def has_chunks(self):
         return bool(self.chunks)
@@ -139,17 +180,6 @@ class DirectoryEntry:
         self.chunks = [ Chunk(chunk_data, self.content_hash_type)
                         for chunk_data in result_set ]
 
-    def _read_content_hash_type(self):
-        bit_mask     = _Flags.ContentHashType
-        right_shifts = 0
-        while bit_mask & 1 == 0:
-            bit_mask >>= 1
-            right_shifts += 1
-        hash_type = ((self.flags & _Flags.ContentHashType) >> right_shifts) + 1
-        self.content_hash_type = \
-            hash_type if 0 < hash_type < ContentHashTypes.UpperBound \
-                      else ContentHashTypes.Unknown
-
     # def BacktracePath(self, containing_catalog, repo):
     #     """ Tries to reconstruct the full path of a DirectoryEntry """
     #     dirent  = self
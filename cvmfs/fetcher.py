@@ -51,6 +51,18 @@ class Fetcher(object):
         """
         return self._retrieve(file_name, self._retrieve_raw_file)
 
+    def retrieve_derived_file(self, file_name, derive_fn):
+        """
+        Method to retrieve a file that is computed locally from repository
+        content (e.g. an index). It is taken from the cache if it exists, or
+        written by derive_fn otherwise and stored in the cache
+        :param file_name: name of the derived file in the cache
+        :param derive_fn: callable receiving a writable file object to fill
+        :return: a file read-only file object that represents the cached file
+        """
+        return self._retrieve(file_name,
+                              lambda _, cached_file: derive_fn(cached_file))
+
     def _retrieve(self, file_name, retrieve_fn):
         cached_file_ro = self.__cache.get(file_name)
         if cached_file_ro:
@@ -22,19 +22,19 @@ class RevisionTag:
                ' FROM tags ORDER BY timestamp DESC'
 
     @staticmethod
-    def sql_query_name(name):
+    def sql_query_name():
         return 'SELECT ' + RevisionTag._database_fields() + \
-               ' FROM tags WHERE name=' + str(name) + ' LIMIT 1'
+               ' FROM tags WHERE name = ? LIMIT 1'
 
     @staticmethod
-    def sql_query_revision(revision):
+    def sql_query_revision():
         return 'SELECT ' + RevisionTag._database_fields() + \
-               ' FROM tags WHERE revision=' + str(revision) + ' LIMIT 1'
+               ' FROM tags WHERE revision = ? LIMIT 1'
 
     @staticmethod
-    def sql_query_date(timestamp):
+    def sql_query_date():
         return 'SELECT ' + RevisionTag._database_fields() + \
-               ' FROM tags WHERE timestamp >' + str(timestamp) + \
+               ' FROM tags WHERE timestamp > ?' + \
                ' ORDER BY timestamp ASC LIMIT 1'
 
     def __init__(self, sql_result):
@@ -74,8 +74,8 @@ class History(DatabaseObject):
     def __iter__(self):
         return self.list_tags().__iter__()
 
-    def _get_tag_by_query(self, query):
-        result = self.run_sql(query)
+    def _get_tag_by_query(self, query, parameters):
+        result = self.run_sql(query, parameters)
         if result:
             return RevisionTag(result[0])
 
@@ -84,13 +84,16 @@ class History(DatabaseObject):
         return [ RevisionTag(sql_res) for sql_res in results ]
 
     def get_tag_by_name(self, tag_name):
-        return self._get_tag_by_query(RevisionTag.sql_query_name(tag_name))
+        return self._get_tag_by_query(RevisionTag.sql_query_name(),
+                                      (tag_name,))
 
     def get_tag_by_revision(self, revision):
-        return self._get_tag_by_query(RevisionTag.sql_query_revision(revision))
+        return self._get_tag_by_query(RevisionTag.sql_query_revision(),
+                                      (revision,))
 
     def get_tag_by_date(self, timestamp):
-        return self._get_tag_by_query(RevisionTag.sql_query_date(timestamp))
+        return self._get_tag_by_query(RevisionTag.sql_query_date(),
+                                      (timestamp,))
 
     def _read_properties(self):
         self.read_properties_table(lambda prop_key, prop_value:
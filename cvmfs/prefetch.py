@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This file is part of the CernVM File System auxiliary tools.
+
+A catalog prefetcher downloads and opens nested catalogs in background
+threads before a traversal actually needs them. Thus, the traversal overlaps
+network I/O with SQLite scanning instead of alternating between the two.
+
+Prefetched catalogs are pinned in the repository's catalog cache until they
+are handed out by retrieve(). The number (and summed size) of prefetched
+catalogs that were not handed out yet is bounded by a read-ahead window.
+"""
+
+import collections
+import sys
+import threading
+
+
+class CatalogPrefetcher(object):
+    """ Read-ahead of catalogs for RevisionIterator and CatalogTreeIterator
+        :param threads:          number of concurrent downloads
+        :param max_pending:      number of catalogs prefetched ahead at most
+        :param max_pending_size: summed size (see CatalogReference) of the
+                                 catalogs prefetched ahead (None for no limit)
+    """
+
+    class _Prefetch:
+        def __init__(self, reference):
+            self.reference = reference
+            self.started   = False
+            self.done      = threading.Event()
+            self.catalog   = None
+            self.exc_info  = None
+
+    def __init__(self, repository, threads = 4, max_pending = 16,
+                 max_pending_size = None):
+        self.repository       = repository
+        self.max_pending      = max_pending
+        self.max_pending_size = max_pending_size
+        self._queue           = collections.deque()
+        self._prefetches      = {}
+        self._window_count    = 0
+        self._window_size     = 0
+        self._stopped         = False
+        self._condition       = threading.Condition()
+        self._threads         = [ threading.Thread(target = self._work)
+                                  for _ in range(threads) ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Stops the background downloads and releases prefetched catalogs """
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for prefetch in self._prefetches.values():
+            if prefetch.catalog is not None:
+                self.repository.unpin_catalog(prefetch.catalog)
+        self._prefetches.clear()
+
+    def prefetch(self, references):
+        """ Queues CatalogReferences for background download, in the order
+            they are expected to be needed
+        """
+        with self._condition:
+            for reference in references:
+                if reference.hash in self._prefetches:
+                    continue
+                prefetch = self._Prefetch(reference)
+                self._prefetches[reference.hash] = prefetch
+                self._queue.append(prefetch)
+            self._condition.notify_all()
+
+    def retrieve(self, reference):
+        """ Provides the catalog of a CatalogReference, waiting for a running
+            download if necessary. The catalog is returned pinned in the
+            repository's catalog cache, the caller has to unpin it.
+        """
+        with self._condition:
+            prefetch = self._prefetches.pop(reference.hash, None)
+            if prefetch is not None and not prefetch.started:
+                self._queue.remove(prefetch)
+                prefetch = None
+        if prefetch is None:
+            return self._retrieve_pinned(reference)
+        prefetch.done.wait()
+        with self._condition:
+            self._window_count -= 1
+            self._window_size  -= prefetch.reference.size
+            self._condition.notify_all()
+        if prefetch.exc_info:
+            exc_type, exc_value, exc_traceback = prefetch.exc_info
+            raise exc_type, exc_value, exc_traceback
+        return prefetch.catalog
+
+    def _retrieve_pinned(self, reference):
+        # pin first: catalogs are pinned by hash and the catalog might be
+        # evicted by concurrent downloads right after being opened otherwise
+        self.repository.pin_catalog(reference)
+        try:
+            return reference.retrieve_from(self.repository)
+        except:
+            self.repository.unpin_catalog(reference)
+            raise
+
+    def _window_allows(self, prefetch):
+        if self._window_count == 0:
+            return True
+        if self._window_count >= self.max_pending:
+            return False
+        return self.max_pending_size is None or \
+               self._window_size + prefetch.reference.size <= \
+               self.max_pending_size
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._stopped and \
+                      not (self._queue and self._window_allows(self._queue[0])):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                prefetch = self._queue.popleft()
+                prefetch.started    = True
+                self._window_count += 1
+                self._window_size  += prefetch.reference.size
+            try:
+                prefetch.catalog = self._retrieve_pinned(prefetch.reference)
+            except Exception:
+                prefetch.exc_info = sys.exc_info()
+            prefetch.done.set()
@@ -5,7 +5,10 @@ Created by René Meusel
 This file is part of the CernVM File System auxiliary tools.
 """
 
+import collections
 import os
+import threading
+import weakref
 from datetime import datetime
 
 import dateutil.parser
@@ -13,13 +16,15 @@ from dateutil.tz import tzutc
 
 import _common
 from _exceptions import RepositoryNotFound, FileNotFoundInRepository, \
-    RepositoryVerificationFailed, HistoryNotFound
-from catalog import Catalog
+    RepositoryVerificationFailed, HistoryNotFound, CheckpointMismatch, \
+    MergeQueryRequired
+from catalog import Catalog, ContentHashIndex, CatalogReferenceFilters
 from certificate import Certificate
 from fetcher import RemoteFetcher, LocalFetcher
 from history import History
 from manifest import Manifest
-from revision import Revision, RevisionIterator
+from revision import Revision, RevisionIterator, ParallelRevisionIterator, \
+    DiffTypes
 from whitelist import Whitelist
 from repoinfo import RepoInfo
 
@@ -27,9 +32,21 @@ from repoinfo import RepoInfo
 class Repository(object):
     """ Wrapper around a CVMFS Repository representation """
 
+    # bounds of the cache of opened catalogs, can be overridden per instance
+    #   max_open_catalogs:     number of catalogs kept open
+    #   max_open_catalog_size: summed file size of open catalogs in bytes
+    #                          (None for no limit)
+    max_open_catalogs     = 1024
+    max_open_catalog_size = None
+
     def __init__(self, fetcher):
         self._fetcher = fetcher
-        self._opened_catalogs = {}
+        self._opened_catalogs      = collections.OrderedDict()
+        self._opened_catalogs_size = 0
+        self._pinned_catalogs      = {}
+        self._evicted_catalogs     = weakref.WeakValueDictionary()
+        self._opened_catalogs_lock = threading.RLock()
+        self._subtree_statistics   = {}
         self._read_manifest()
         self._try_to_get_last_replication_timestamp()
         self._try_to_get_replication_state()
@@ -58,6 +75,24 @@ class Repository(object):
     def __iter__(self):
         return RevisionIterator(self.get_current_revision())
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Closes all catalogs opened through this repository """
+        with self._opened_catalogs_lock:
+            catalogs = self._opened_catalogs.values() + \
+                       self._evicted_catalogs.values()
+            self._opened_catalogs.clear()
+            self._evicted_catalogs.clear()
+            self._opened_catalogs_size = 0
+            self._pinned_catalogs.clear()
+        for catalog in catalogs:
+            catalog.close()
+
     def _read_manifest(self):
         try:
             with self._fetcher.retrieve_raw_file(_common._MANIFEST_NAME) as manifest_file:
@@ -139,13 +174,13 @@ class Repository(object):
             return self._get_revision_by_tag(revision_data)
 
     def _get_revision_by_number(self, revision):
-        history = self.retrieve_history()
-        revision_tag = history.get_tag_by_revision(revision)
+        with self.retrieve_history() as history:
+            revision_tag = history.get_tag_by_revision(revision)
         return Revision(self, revision_tag)
 
     def _get_revision_by_tag(self, tag_name):
-        history = self.retrieve_history()
-        revision_tag = history.get_tag_by_name(tag_name)
+        with self.retrieve_history() as history:
+            revision_tag = history.get_tag_by_name(tag_name)
         return Revision(self, revision_tag)
 
     def retrieve_whitelist(self):
@@ -159,27 +194,181 @@ class Repository(object):
         return Certificate(certificate)
 
     def retrieve_catalog(self, catalog_hash):
-        """ Download and open a catalog from the repository """
-        if catalog_hash in self._opened_catalogs:
-            return self._opened_catalogs[catalog_hash]
+        """ Download and open a catalog from the repository
+            Opened catalogs are kept in a least recently used cache. Once it
+            exceeds max_open_catalogs or max_open_catalog_size, the least
+            recently used catalogs are evicted unless they are pinned. Evicted
+            catalogs are suspended (see DatabaseObject), i.e. their files are
+            closed right away, and they reopen themselves when used again.
+            Catalogs used by several threads at once must be pinned.
+        """
+        with self._opened_catalogs_lock:
+            catalog = self._touch_cached_catalog(catalog_hash)
+        if catalog is not None:
+            return catalog
         return self._retrieve_and_open_catalog(catalog_hash)
 
+    def pin_catalog(self, catalog):
+        """ Protects an opened catalog from being evicted from the cache """
+        with self._opened_catalogs_lock:
+            pins = self._pinned_catalogs.get(catalog.hash, 0)
+            self._pinned_catalogs[catalog.hash] = pins + 1
+
+    def unpin_catalog(self, catalog):
+        """ Releases a pin obtained by pin_catalog() """
+        with self._opened_catalogs_lock:
+            pins = self._pinned_catalogs.get(catalog.hash, 0)
+            if pins > 1:
+                self._pinned_catalogs[catalog.hash] = pins - 1
+                return
+            self._pinned_catalogs.pop(catalog.hash, None)
+            self._evict_catalogs()
+
+    def get_subtree_statistics(self, catalog_hash):
+        """ Statistics of a catalog including the counters of its subtree
+            Catalogs lacking stored subtree counters are summed up bottom-up
+            from their nested catalogs. Results are memoized by catalog hash,
+            so catalogs shared by several revisions are only read once.
+        """
+        pending = [ (catalog_hash, None, None) ]
+        while pending:
+            clg_hash, statistics, nested_hashes = pending.pop()
+            if clg_hash in self._subtree_statistics:
+                continue
+            if statistics is None:
+                catalog    = self.retrieve_catalog(clg_hash)
+                statistics = catalog.get_statistics()
+                if not statistics.has_subtree_statistics():
+                    # revisit once all nested catalogs are done
+                    nested_hashes = [ ref.hash for ref in catalog.list_nested() ]
+                    pending.append((clg_hash, statistics, nested_hashes))
+                    pending.extend([ (nested_hash, None, None)
+                                     for nested_hash in nested_hashes ])
+                    continue
+            else:
+                statistics._set_subtree_statistics(
+                    [ self._subtree_statistics[nested_hash]
+                      for nested_hash in nested_hashes ])
+            self._subtree_statistics[clg_hash] = statistics
+        return self._subtree_statistics[catalog_hash]
+
+    def retrieve_content_hash_index(self, catalog):
+        """ Retrieve the content hash index of a catalog (built only once) """
+        index_name = "data/" + catalog.hash[:2] + "/" + catalog.hash[2:] + \
+                     "C.hashindex"
+        index_file = self._fetcher.retrieve_derived_file(index_name,
+            lambda index_file: ContentHashIndex.build(catalog, index_file.name))
+        return ContentHashIndex(index_file)
+
     def retrieve_object(self, object_hash, hash_suffix = ''):
         """ Retrieves an object from the content addressable storage """
         path = "data/" + object_hash[:2] + "/" + object_hash[2:] + hash_suffix
         return self._fetcher.retrieve_file(path)
 
+    def is_catalog_cached(self, catalog_hash):
+        """ Checks if a catalog is open in the catalog cache right now """
+        with self._opened_catalogs_lock:
+            return catalog_hash in self._opened_catalogs
+
+    def release_catalog(self, catalog):
+        """ Releases a pin like unpin_catalog() and evicts the catalog right
+            away (closing its file), unless it is still pinned by someone else
+            Other holders of the catalog can still use it (see retrieve_catalog)
+        """
+        with self._opened_catalogs_lock:
+            self.unpin_catalog(catalog)
+            if catalog.hash in self._pinned_catalogs or \
+               self._opened_catalogs.get(catalog.hash) is not catalog:
+                return
+            self._drop_cached_catalog(catalog.hash)
+            self._evicted_catalogs[catalog.hash] = catalog
+            catalog.suspend()
+
     def close_catalog(self, catalog):
-        try:
-            del self._opened_catalogs[catalog.hash]
-        except KeyError, e:
-            print "not found:" , catalog.hash
+        """ Removes a catalog from the cache and closes it right away """
+        with self._opened_catalogs_lock:
+            if self._opened_catalogs.get(catalog.hash) is catalog:
+                self._drop_cached_catalog(catalog.hash)
+            if self._evicted_catalogs.get(catalog.hash) is catalog:
+                del self._evicted_catalogs[catalog.hash]
+        catalog.close()
 
     def _retrieve_and_open_catalog(self, catalog_hash):
         catalog_file = self.retrieve_object(catalog_hash, 'C')
+        with self._opened_catalogs_lock:
+            catalog = self._touch_cached_catalog(catalog_hash)
+            if catalog is None:
+                # an evicted catalog still in use is resumed, not duplicated
+                evicted = self._evicted_catalogs.pop(catalog_hash, None)
+                if evicted is not None and evicted._resume(catalog_file):
+                    self._cache_catalog(evicted)
+                    return evicted
+        if catalog is not None:
+            catalog_file.close()
+            return catalog
         new_catalog = Catalog(catalog_file, catalog_hash)
-        self._opened_catalogs[catalog_hash] = new_catalog
-        return new_catalog
+        new_catalog._reopen = self._make_catalog_reopener()
+        with self._opened_catalogs_lock:
+            catalog = self._touch_cached_catalog(catalog_hash)
+            if catalog is None:
+                self._cache_catalog(new_catalog)
+                return new_catalog
+        new_catalog.close() # opened concurrently by another thread
+        return catalog
+
+    def _make_catalog_reopener(self):
+        """ Catalogs refer to the repository weakly, the repository's cache
+            refers to them. Without a repository they cannot be reopened.
+        """
+        repository = weakref.ref(self)
+        def reopen(catalog):
+            if repository() is None:
+                catalog.close()
+                return
+            repository()._retrieve_and_open_catalog(catalog.hash)
+            if catalog._suspended: # not reachable through the cache anymore
+                catalog.close()
+        return reopen
+
+    def _cache_catalog(self, catalog):
+        self._opened_catalogs[catalog.hash] = catalog
+        self._opened_catalogs_size += catalog.db_size()
+        self._evict_catalogs()
+
+    def _touch_cached_catalog(self, catalog_hash):
+        """ Finds a cached catalog and marks it as most recently used """
+        catalog = self._opened_catalogs.pop(catalog_hash, None)
+        if catalog is not None:
+            self._opened_catalogs[catalog_hash] = catalog
+        return catalog
+
+    def _drop_cached_catalog(self, catalog_hash):
+        catalog = self._opened_catalogs.pop(catalog_hash)
+        self._opened_catalogs_size -= catalog.db_size()
+        return catalog
+
+    def _catalog_cache_exceeded(self):
+        return len(self._opened_catalogs) > self.max_open_catalogs or \
+               (self.max_open_catalog_size is not None and
+                self._opened_catalogs_size > self.max_open_catalog_size)
+
+    def _evict_catalogs(self):
+        """ Suspends least recently used catalogs until the cache fits its
+            bounds again. Pinned catalogs and the most recently used one are
+            never evicted, hence the bounds might be exceeded temporarily.
+            Callers might still hold evicted catalogs, they are remembered
+            (weakly) to resume them instead of opening a second instance.
+        """
+        if not self._catalog_cache_exceeded():
+            return
+        for catalog_hash in self._opened_catalogs.keys()[:-1]:
+            if catalog_hash in self._pinned_catalogs:
+                continue
+            catalog = self._drop_cached_catalog(catalog_hash)
+            self._evicted_catalogs[catalog_hash] = catalog
+            catalog.suspend()
+            if not self._catalog_cache_exceeded():
+                break
 
 
 def all_local():
@@ -6,46 +6,219 @@ This file is part of the CernVM File System auxiliary tools.
 """
 
 import collections
+import itertools
+import json
+import multiprocessing
+import os
+import Queue
+import sqlite3
+import sys
+import threading
+import traceback
 
-from _exceptions import NestedCatalogNotFound
+from _common     import _canonicalize_path, _split_md5_paths, \
+                        _sqlite_max_attached, _attach_name_readonly
+from catalog     import CatalogIterator
+from dirent      import DirectoryEntry, _Flags
+from _exceptions import NestedCatalogNotFound, CheckpointMismatch, \
+                        MergeQueryRequired
+
+
+class DiffTypes:
+    """ Enumeration of the changes reported by Revision.diff() """
+    Added    = 1
+    Removed  = 2
+    Modified = 3
+
+    @staticmethod
+    def to_string(diff_type):
+        if diff_type == DiffTypes.Added:
+            return "added"
+        elif diff_type == DiffTypes.Removed:
+            return "removed"
+        elif diff_type == DiffTypes.Modified:
+            return "modified"
+        else:
+            return "unknown"
 
 
 class RevisionIterator(object):
-    """ Iterates through all directory entries in a whole Repository """
+    """ Iterates through all directory entries in a whole Repository
+        The catalogs on the iterator's stack are pinned in the repository's
+        catalog cache until the iterator is done with them. With a
+        CatalogPrefetcher the nested catalogs of every catalog pushed on the
+        stack are downloaded in the background.
+        Nested catalogs can be skipped (with their mountpoint and subtree)
+        by the reference_filter before they are downloaded, or by the
+        catalog_filter once they are opened.
+        With a checkpoint_file the position of the iteration (the catalog
+        stack and the pending entries of each catalog) is saved every
+        checkpoint_interval entries. An iterator created with an existing
+        checkpoint_file resumes from there, the file is removed once the
+        iteration is complete.
+        If memory_bounded is set, every catalog opened by the iteration is
+        evicted from the catalog cache (closing its file) as soon as the
+        iteration is done with it, unless it is pinned elsewhere. Catalogs
+        that were open already are left to the cache. Pending entries are
+        kept as md5 paths only (see CatalogIterator). Thus, the memory used
+        depends on the depth of the tree, not on its size.
+    """
 
     class _CatalogIterator:
-        def __init__(self, catalog):
+        def __init__(self, catalog, path=None, max_depth=None, backlog=None,
+                     compact=False):
             self.catalog          = catalog
-            self.catalog_iterator = catalog.__iter__()
+            self.path             = path
+            self.max_depth        = max_depth
+            self.catalog_iterator = CatalogIterator(catalog, path, max_depth,
+                                                    backlog, compact)
 
-    def __init__(self, revision, catalog_hash=None, catalog_filter=None, finish_catalog_callback=None):
+    def __init__(self, revision, catalog_hash=None, catalog_filter=None,
+                 finish_catalog_callback=None, prefetcher=None, path=None,
+                 max_depth=None, reference_filter=None, checkpoint_file=None,
+                 checkpoint_interval=10000, memory_bounded=False):
         self.revision    = revision
         self.catalog_stack = collections.deque()
         self.catalog_filter = catalog_filter
+        self.reference_filter = reference_filter
         self.finish_catalog_callback = finish_catalog_callback
-        if catalog_hash is None:
+        self.prefetcher = prefetcher
+        self.max_depth  = max_depth
+        self.memory_bounded = memory_bounded
+        self._owned_catalogs = set() # hashes of catalogs opened by the iteration
+        self.checkpoint_file     = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self._unsaved_entries    = 0
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            self._restore_checkpoint()
+            return
+        if path is not None:
+            path    = revision._normalize_path(path)
+            catalog = revision.retrieve_catalog_for_path(path)
+        elif catalog_hash is None:
+            self._note_ownership(revision.root_hash)
             catalog = revision.retrieve_root_catalog()
         else:
+            self._note_ownership(catalog_hash)
             catalog = revision.retrieve_catalog(catalog_hash)
-        self._push_catalog(catalog, nofilter=True)
+        if path is None:
+            path = catalog.root_prefix if not catalog.is_root() else ''
+        self._base_depth = path.count('/')
+        self._push_catalog(catalog, nofilter=True, path=path)
 
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # iterations left early (e.g. by break) release their pins here
+        if hasattr(self, 'catalog_stack'):
+            self.close()
+
+    def close(self):
+        """ Stops the iteration and releases the catalogs still on the stack """
+        while self._has_more():
+            catalog_iterator = self.catalog_stack.pop()
+            self.revision.repository.unpin_catalog(catalog_iterator.catalog)
+
     def next(self):
+        # entries returned so far are done once the next one is requested
+        if self.checkpoint_file is not None and \
+           self._unsaved_entries >= self.checkpoint_interval:
+            self.save_checkpoint()
+        try:
+            full_path, dirent = self._next_entry()
+        except StopIteration:
+            self._remove_checkpoint()
+            raise
+        self._unsaved_entries += 1
+        return full_path, dirent
+
+    def _next_entry(self):
         full_path, dirent = self._get_next_dirent()
-        if dirent.is_nested_catalog_mountpoint():
+        if dirent.is_nested_catalog_mountpoint() and \
+           self._may_enter(full_path):
             self._fetch_and_push_catalog(full_path)
-            return self.next()  # same directory entry is also in nested catalog
+            return self._next_entry()  # same directory entry is also in nested catalog
         return full_path, dirent
 
+    def save_checkpoint(self):
+        """ Atomically replaces the checkpoint_file by the current position """
+        state = { 'root_hash'  : self.revision.root_hash,
+                  'max_depth'  : self.max_depth,
+                  'base_depth' : self._base_depth,
+                  'catalogs'   : [ { 'hash'      : frame.catalog.hash,
+                                     'path'      : frame.path,
+                                     'max_depth' : frame.max_depth,
+                                     'backlog'   : frame.catalog_iterator.get_backlog() }
+                                   for frame in self.catalog_stack ] }
+        temp_path = self.checkpoint_file + '.tmp'
+        with open(temp_path, 'w') as checkpoint:
+            # paths are byte strings, latin-1 maps them to unicode losslessly
+            json.dump(state, checkpoint, encoding='latin-1')
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.rename(temp_path, self.checkpoint_file)
+        self._unsaved_entries = 0
+
+    def _restore_checkpoint(self):
+        with open(self.checkpoint_file) as checkpoint:
+            state = json.load(checkpoint)
+        if state['root_hash'] != self.revision.root_hash:
+            raise CheckpointMismatch(self.checkpoint_file,
+                                     self.revision.root_hash)
+        self.max_depth   = state['max_depth']
+        self._base_depth = state['base_depth']
+        for frame in state['catalogs']:
+            self._note_ownership(str(frame['hash']))
+            catalog = self.revision.retrieve_catalog(str(frame['hash']))
+            path    = frame['path']
+            if path is not None:
+                path = path.encode('latin-1')
+            backlog = [ (entry_path.encode('latin-1'), md5path_1, md5path_2)
+                        for entry_path, md5path_1, md5path_2 in frame['backlog'] ]
+            self.revision.repository.pin_catalog(catalog)
+            self.catalog_stack.append(self._CatalogIterator(
+                catalog, path, frame['max_depth'], backlog,
+                self.memory_bounded))
+            if self.prefetcher is not None:
+                self.prefetcher.prefetch(self._pending_nested(catalog, backlog))
+
+    def _pending_nested(self, catalog, backlog):
+        """ Nested catalogs below the pending entries of a restored catalog """
+        pending = set([ entry_path for entry_path, _, _ in backlog ])
+        nested_refs = []
+        for nested_ref in self._nested_below(catalog, None):
+            path = nested_ref.root_path
+            while path and path not in pending:
+                path = path[:path.rfind('/')]
+            if path in pending:
+                nested_refs.append(nested_ref)
+        return nested_refs
+
+    def _remove_checkpoint(self):
+        if self.checkpoint_file is not None and \
+           os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def _remaining_depth(self, path):
+        """ Directory levels left below path (None for no depth limit) """
+        if self.max_depth is None:
+            return None
+        return self.max_depth - (path.count('/') - self._base_depth)
+
     def _get_next_dirent(self):
+        if not self._has_more():
+            raise StopIteration()
         try:
             return self._get_current_catalog().catalog_iterator.next()
         except StopIteration, e:
             self._pop_catalog()
-            if not self._has_more():
-                raise StopIteration()
             return self._get_next_dirent()
 
     def _fetch_and_push_catalog(self, catalog_mountpoint):
@@ -53,17 +226,71 @@ class RevisionIterator(object):
         nested_ref = current_catalog.find_nested_for_path(catalog_mountpoint)
         if not nested_ref:
             raise NestedCatalogNotFound(self.revision.repository)
-        new_catalog     = nested_ref.retrieve_from(self.revision.repository)
-        self._push_catalog(new_catalog)
+        if self.reference_filter and not self.reference_filter(nested_ref):
+            return
+        max_depth = self._remaining_depth(catalog_mountpoint)
+        self._note_ownership(nested_ref.hash)
+        if self.prefetcher is None:
+            new_catalog = nested_ref.retrieve_from(self.revision.repository)
+            self._push_catalog(new_catalog, max_depth=max_depth)
+            return
+        new_catalog = self.prefetcher.retrieve(nested_ref)
+        try:
+            self._push_catalog(new_catalog, max_depth=max_depth)
+        finally:
+            self.revision.repository.unpin_catalog(new_catalog)
 
     def _has_more(self):
         return len(self.catalog_stack) > 0
 
-    def _push_catalog(self, catalog, nofilter=False):
+    def _push_catalog(self, catalog, nofilter=False, path=None, max_depth=None):
+        self.revision.repository.pin_catalog(catalog)
         if not nofilter and self.catalog_filter and not self.catalog_filter(catalog):
+            self._release_catalog(catalog)
             return
-        catalog_iterator = self._CatalogIterator(catalog)
+        if path is not None:
+            max_depth = self.max_depth
+        catalog_iterator = self._CatalogIterator(catalog, path, max_depth,
+                                                 compact=self.memory_bounded)
         self.catalog_stack.append(catalog_iterator)
+        if self.prefetcher is not None:
+            nested_refs = self._nested_below(catalog, path)
+            for nested_ref in nested_refs: # opened by the prefetcher for us
+                self._note_ownership(nested_ref.hash)
+            self.prefetcher.prefetch(nested_refs)
+
+    def _note_ownership(self, catalog_hash):
+        """ Remembers catalogs about to be opened for this iteration """
+        if self.memory_bounded and \
+           not self.revision.repository.is_catalog_cached(catalog_hash):
+            self._owned_catalogs.add(catalog_hash)
+
+    def _release_catalog(self, catalog):
+        """ Unpins a catalog, memory_bounded iterations also evict their own """
+        repository = self.revision.repository
+        if catalog.hash in self._owned_catalogs:
+            self._owned_catalogs.discard(catalog.hash)
+            repository.release_catalog(catalog)
+        else:
+            repository.unpin_catalog(catalog)
+
+    def _nested_below(self, catalog, path):
+        """ Nested catalogs the traversal of catalog (from path) might enter,
+            in the order they are entered (i.e. descending, see next())
+        """
+        nested_refs = [ nested_ref for nested_ref in catalog.list_nested()
+                        if (not path or
+                            nested_ref.root_path.startswith(path + '/'))
+                        and self._may_enter(nested_ref.root_path)
+                        and (not self.reference_filter or
+                             self.reference_filter(nested_ref)) ]
+        return sorted(nested_refs, key=lambda ref: ref.root_path.split('/'),
+                      reverse=True)
+
+    def _may_enter(self, mountpoint):
+        """ Mountpoints at (or beyond) the depth limit are not entered """
+        remaining_depth = self._remaining_depth(mountpoint)
+        return remaining_depth is None or remaining_depth > 0
 
     def _get_current_catalog(self):
         return self.catalog_stack[-1]
@@ -71,25 +298,320 @@ class RevisionIterator(object):
     def _pop_catalog(self):
         if self.finish_catalog_callback:
             self.finish_catalog_callback(self._get_current_catalog().catalog)
-        return self.catalog_stack.pop()
+        catalog_iterator = self.catalog_stack.pop()
+        self._release_catalog(catalog_iterator.catalog)
+        return catalog_iterator
+
+
+class ParallelRevisionIterator(object):
+    """ Iterates through all directory entries in a whole Repository using a
+        pool of worker threads, each of them traversing one catalog at a time
+        Nested catalogs are queued for the pool as soon as their mountpoint
+        shows up, hence independent catalogs are downloaded and scanned
+        concurrently. Entries are yielded as (full_path, dirent) in the order
+        the workers produce them, or (if ordered is set) in exactly the order
+        of RevisionIterator. The latter buffers the entries of catalogs that
+        are finished before the iteration reaches them. Once there are
+        max_buffered_batches batches (plus at most two for every catalog on
+        the way to the current one), workers wait until the iteration reaches
+        their catalog. Catalogs reached before any worker started them are
+        traversed by the iterating thread itself.
+        Note: threads overlap downloads and SQLite queries, but the creation
+              of DirectoryEntry objects is still bound by the GIL
+    """
+
+    # marks the position of a nested catalog in a catalog's entries
+    class _NestedCatalog:
+        def __init__(self, mountpoint):
+            self.mountpoint = mountpoint
+
+    def __init__(self, revision, workers = 4, ordered = False,
+                 batch_size = 1000, max_buffered_batches = None):
+        self.revision      = revision
+        self.ordered       = ordered
+        self.batch_size    = batch_size
+        self.max_buffered_batches = max_buffered_batches or 4 * workers
+        self._work_queue   = Queue.Queue()
+        self._result_queue = Queue.Queue(maxsize = 4 * workers)
+        self._stopped      = threading.Event()
+        self._pending      = 0
+        self._pending_lock = threading.Lock()
+        self._condition    = threading.Condition() # guards the ordered state
+        self._buffers      = {}  # mountpoint -> (deque of batches, done flag)
+        self._buffered     = 0   # number of batches in all buffers
+        self._emit_stack   = []  # mountpoints of catalogs being yielded
+        self._unclaimed    = {}  # mountpoint -> hash of catalogs not started
+        self._inline       = {}  # mountpoint -> batches traversed by next()
+        self._error        = None
+        self._current      = iter(())
+        self._workers      = [ threading.Thread(target = self._work)
+                               for _ in range(workers) ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        self._submit('', revision.root_hash)
+        if ordered:
+            self._emit_stack.append('')
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Stops the worker threads (unfinished catalogs are abandoned)
+            Iterations that are not run to completion must be closed
+        """
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        for _ in self._workers:
+            self._work_queue.put(None)
+        while any(worker.is_alive() for worker in self._workers):
+            self._drain_results()
+            for worker in self._workers:
+                worker.join(0.01)
+        self._workers = []
+        for batches in self._inline.values():
+            batches.close()
+        self._inline = {}
+
+    def next(self):
+        while True:
+            for item in self._current:
+                if not isinstance(item, self._NestedCatalog):
+                    return item
+                # continue with the rest of this batch after the nested catalog
+                self._enter_nested(item.mountpoint, list(self._current))
+            self._current = self._next_batch()
+
+    def _enter_nested(self, mountpoint, rest_of_batch):
+        with self._condition:
+            parent_batches, _ = self._buffers[self._emit_stack[-1]]
+            parent_batches.appendleft(rest_of_batch)
+            self._buffered += 1
+            self._emit_stack.append(mountpoint)
+            self._condition.notify_all()
+
+    def _next_batch(self):
+        """ Fetches the next batch of entries to be yielded """
+        if not self.ordered:
+            while True:
+                if self._pending == 0:
+                    self.close()
+                    raise StopIteration()
+                mountpoint, batch, done = self._receive()
+                if batch:
+                    return iter(batch)
+        while True:
+            with self._condition:
+                batch, mountpoint = self._wait_for_batch()
+            if self._error is not None:
+                self.close()
+                exc_type, exc_value, exc_traceback = self._error
+                raise exc_type, exc_value, exc_traceback
+            if batch is not None:
+                return iter(batch)
+            if mountpoint is None:
+                self.close()
+                raise StopIteration()
+            try:
+                batch, done = next(self._inline[mountpoint])
+            except:
+                self.close()
+                raise
+            self._buffer_batch(mountpoint, batch, done)
+
+    def _wait_for_batch(self):
+        """ Waits for the next batch of the catalog on top of the emit stack
+            Returns (batch, None), or (None, mountpoint) if that catalog is to
+            be traversed here, or (None, None) at the end of the iteration
+        """
+        while self._emit_stack and self._error is None:
+            mountpoint = self._emit_stack[-1]
+            batches, done = self._buffers.setdefault(mountpoint,
+                                                     (collections.deque(), [ False ]))
+            if batches:
+                self._buffered -= 1
+                self._condition.notify_all()
+                return batches.popleft(), None
+            if done[0]:
+                del self._buffers[mountpoint]
+                if mountpoint in self._inline:
+                    self._inline.pop(mountpoint).close()
+                self._emit_stack.pop()
+                self._condition.notify_all()
+                continue
+            if mountpoint in self._inline:
+                return None, mountpoint
+            catalog_hash = self._unclaimed.pop(mountpoint, None)
+            if catalog_hash is not None: # no worker got to it yet
+                self._inline[mountpoint] = self._catalog_batches(mountpoint,
+                                                                 catalog_hash)
+                return None, mountpoint
+            self._condition.wait()
+        return None, None
+
+    def _buffer_batch(self, mountpoint, batch, done):
+        """ Buffers a batch of an ordered iteration, waiting while too many
+            batches are buffered unless the batch is needed next
+        """
+        with self._condition:
+            batches, done_flag = self._buffers.setdefault(mountpoint,
+                                                          (collections.deque(), [ False ]))
+            while batch and not self._stopped.is_set() and \
+                  self._buffered >= self.max_buffered_batches and \
+                  (batches or self._emit_stack[-1:] != [ mountpoint ]):
+                self._condition.wait()
+            if self._stopped.is_set():
+                return False
+            if batch:
+                batches.append(batch)
+                self._buffered += 1
+            done_flag[0] = done
+            self._condition.notify_all()
+            return True
+
+    def _receive(self):
+        """ Waits for the next result message of the workers """
+        result = self._result_queue.get()
+        if isinstance(result, tuple) and len(result) == 2: # exception info
+            self.close()
+            exc_type, exc_value, exc_traceback = result[1]
+            raise exc_type, exc_value, exc_traceback
+        if result[2]:
+            with self._pending_lock:
+                self._pending -= 1
+        return result
+
+    def _drain_results(self):
+        try:
+            while True:
+                self._result_queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _submit(self, mountpoint, catalog_hash):
+        with self._pending_lock:
+            self._pending += 1
+        if self.ordered:
+            with self._condition:
+                self._unclaimed[mountpoint] = catalog_hash
+        self._work_queue.put((mountpoint, catalog_hash))
+
+    def _send(self, message):
+        """ Passes a message to the consumer unless the iteration stopped """
+        while not self._stopped.is_set():
+            try:
+                self._result_queue.put(message, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fail(self, exc_info):
+        if not self.ordered:
+            self._send(('error', exc_info))
+            return
+        with self._condition:
+            if self._error is None:
+                self._error = exc_info
+            self._condition.notify_all()
+
+    def _work(self):
+        while not self._stopped.is_set():
+            work = self._work_queue.get()
+            if work is None:
+                break
+            try:
+                self._process_catalog(*work)
+            except Exception:
+                self._fail(sys.exc_info())
+                break
+
+    def _process_catalog(self, mountpoint, catalog_hash):
+        if self.ordered:
+            with self._condition:
+                if self._unclaimed.pop(mountpoint, None) is None:
+                    return # traversed by the iterating thread already
+        batches = self._catalog_batches(mountpoint, catalog_hash)
+        try:
+            for batch, done in batches:
+                if self.ordered:
+                    delivered = self._buffer_batch(mountpoint, batch, done)
+                else:
+                    delivered = self._send((mountpoint, batch, done))
+                if not delivered:
+                    return
+        finally:
+            batches.close()
+
+    def _catalog_batches(self, mountpoint, catalog_hash):
+        """ Traverses a catalog in batches of (batch, done) and submits its
+            nested catalogs to the pool on the way
+        """
+        repository = self.revision.repository
+        catalog    = self.revision.retrieve_catalog(catalog_hash)
+        repository.pin_catalog(catalog)
+        try:
+            batch = []
+            for full_path, dirent in catalog:
+                if dirent.is_nested_catalog_mountpoint():
+                    nested_ref = catalog.find_nested_for_path(full_path)
+                    if not nested_ref:
+                        raise NestedCatalogNotFound(repository)
+                    self._submit(full_path, nested_ref.hash)
+                    if not self.ordered:
+                        continue
+                    dirent = self._NestedCatalog(full_path)
+                    batch.append(dirent)
+                else:
+                    batch.append((full_path, dirent))
+                if len(batch) >= self.batch_size:
+                    yield batch, False
+                    batch = []
+            yield batch, True
+        finally:
+            repository.unpin_catalog(catalog)
 
 
 class CatalogTreeIterator(object):
+    """ Iterates through all catalogs of a Revision
+        The catalog returned last stays pinned in the repository's catalog
+        cache until the next one is requested. With a CatalogPrefetcher the
+        nested catalogs of every returned catalog are downloaded in the
+        background. Nested catalogs rejected by the reference_filter are
+        skipped with their subtree and never downloaded.
+    """
+
     class _CatalogWrapper:
         def __init__(self, revision):
             self.revision        = revision
             self.catalog           = None
             self.catalog_reference = None
 
-        def get_catalog(self):
+        def get_catalog(self, prefetcher=None):
+            """ Provides the catalog pinned in the repository's cache """
+            repository = self.revision.repository
+            if self.catalog is None and prefetcher is not None:
+                self.catalog = prefetcher.retrieve(self.catalog_reference)
+                return self.catalog
             if self.catalog is None:
-                self.catalog = self.catalog_reference.retrieve_from(self.revision.repository)
+                self.catalog = self.catalog_reference.retrieve_from(repository)
+            repository.pin_catalog(self.catalog)
             return self.catalog
 
-    def __init__(self, revision):
+    def __init__(self, revision, prefetcher=None, reference_filter=None):
         root_catalog = revision.retrieve_root_catalog()
         self.revision    = revision
+        self.prefetcher  = prefetcher
+        self.reference_filter = reference_filter
         self.catalog_stack = collections.deque()
+        self._current_catalog = None
         wrapper            = self._CatalogWrapper(self.revision)
         wrapper.catalog    = root_catalog
         self._push_catalog_wrapper(wrapper)
@@ -97,28 +619,57 @@ class CatalogTreeIterator(object):
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # iterations left early (e.g. by break) release their pins here
+        if hasattr(self, '_current_catalog'):
+            self.close()
+
+    def close(self):
+        """ Stops the iteration and releases the catalog returned last """
+        self.catalog_stack.clear()
+        self._release_current_catalog()
+
     def next(self):
+        self._release_current_catalog()
         if not self._has_more():
             raise StopIteration()
         catalog = self._pop_catalog()
+        self._current_catalog = catalog
         self._push_nested_catalogs(catalog)
         return catalog
 
+    def _release_current_catalog(self):
+        if self._current_catalog is not None:
+            self.revision.repository.unpin_catalog(self._current_catalog)
+            self._current_catalog = None
+
     def _has_more(self):
         return len(self.catalog_stack) > 0
 
     def _push_nested_catalogs(self, catalog):
-        for nested_reference in catalog.list_nested():
+        nested_references = [ nested_ref for nested_ref in catalog.list_nested()
+                              if not self.reference_filter or
+                                 self.reference_filter(nested_ref) ]
+        for nested_reference in nested_references:
             wrapper = self._CatalogWrapper(self.revision)
             wrapper.catalog_reference = nested_reference
             self._push_catalog_wrapper(wrapper)
+        if self.prefetcher is not None:
+            # the stack is processed last in, first out
+            self.prefetcher.prefetch(reversed(nested_references))
 
     def _push_catalog_wrapper(self, catalog):
         self.catalog_stack.append(catalog)
 
     def _pop_catalog(self):
         wrapper = self.catalog_stack.pop()
-        return wrapper.get_catalog()
+        return wrapper.get_catalog(self.prefetcher)
 
 
 class Revision:
@@ -132,6 +683,8 @@ class Revision:
     def __init__(self, repository, tag):
         self.repository = repository
         self._tag = tag
+        # catalog mountpoints seen so far -> catalog hash ('' is the root)
+        self._mount_table = { '': tag.hash }
 
     def __str__(self):
         return '<Revision ' + str(self.revision_number) \
@@ -160,22 +713,549 @@ class Revision:
     def retrieve_root_catalog(self):
         return self.retrieve_catalog(self.root_hash)
 
-    def catalogs(self):
-        return CatalogTreeIterator(self)
+    def catalogs(self, prefetcher=None, reference_filter=None):
+        return CatalogTreeIterator(self, prefetcher, reference_filter)
+
+    def export_columns(self):
+        """
+        Exports the metadata of all directory entries in all catalogs of this
+        revision as NumPy arrays (see Catalog.export_columns())
+        :return: dict of int64 arrays, each entry of the revision appears once
+        """
+        import numpy
+        exports = [ clg.export_columns(exclude_nested_root=True)
+                    for clg in self.catalogs() ]
+        return dict([ (column, numpy.concatenate([ export[column]
+                                                   for export in exports ]))
+                      for column in exports[0] ])
+
+    def map_catalogs(self, map_fn, reduce_fn, initial = None, workers = None,
+                     memo = None):
+        """ Applies map_fn(catalog) to every catalog of the revision and folds
+            the results with reduce_fn(accumulated, result) as they arrive
+            The catalogs are processed by a pool of worker processes (workers
+            defaults to the number of CPUs, 1 processes them in this process).
+            Workers receive catalog hashes and reopen the repository from its
+            source and cache directory, hence map_fn and its results must be
+            picklable and a cache directory should be used.
+            :param memo: dict-like of catalog hash -> (result, nested catalog
+                         hashes), catalogs found in it are not processed again
+                         and new results are added. Sharing a memo between
+                         revisions only processes the catalogs that changed.
+            :return: the folded result (initial if there are no results)
+        """
+        memo        = {} if memo is None else memo
+        accumulated = initial
+        in_flight   = collections.Counter() # hash -> number of mountpoints
+        pending     = [] # AsyncResults (result tuples if run in this process)
+        pool        = None
+        worker_pids = None
+        if workers is None or workers > 1:
+            fetcher = self.repository._fetcher
+            pool = multiprocessing.Pool(workers, _init_map_worker,
+                                        (fetcher.source,
+                                         fetcher.get_cache_path()))
+            worker_pids = set([ worker.pid for worker in pool._pool ])
+        try:
+            catalog_hashes = [ self.root_hash ]
+            while catalog_hashes or in_flight:
+                while catalog_hashes:
+                    catalog_hash = catalog_hashes.pop()
+                    if catalog_hash in memo:
+                        result, nested_hashes = memo[catalog_hash]
+                        accumulated = reduce_fn(accumulated, result)
+                        catalog_hashes.extend(nested_hashes)
+                    elif catalog_hash in in_flight:
+                        in_flight[catalog_hash] += 1
+                    else:
+                        in_flight[catalog_hash] = 1
+                        pending.append(self._map_catalog_async(pool,
+                                                               catalog_hash,
+                                                               map_fn))
+                if in_flight:
+                    catalog_hash, result, nested_hashes, error = \
+                        self._next_map_result(pool, worker_pids, pending)
+                    if error:
+                        raise Exception("Mapping catalog " + catalog_hash +
+                                        " failed:\n" + error)
+                    memo[catalog_hash] = (result, nested_hashes)
+                    # fold once per mountpoint via the memo
+                    catalog_hashes.extend([ catalog_hash ] *
+                                          in_flight.pop(catalog_hash))
+        except:
+            if pool:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return accumulated
+
+    def _map_catalog_async(self, pool, catalog_hash, map_fn):
+        if pool is not None:
+            return pool.apply_async(_map_catalog, (catalog_hash, map_fn))
+        catalog = self.retrieve_catalog(catalog_hash)
+        return (catalog_hash, map_fn(catalog),
+                [ ref.hash for ref in catalog.list_nested() ], None)
+
+    @staticmethod
+    def _next_map_result(pool, worker_pids, pending):
+        """ Removes the next finished result of map_catalogs() from pending
+            AsyncResult.get() re-raises failures of the pool itself, e.g. an
+            unpicklable map_fn or result. The task of a worker process that
+            died never finishes, hence the pool's workers are watched, too.
+        """
+        if pool is None:
+            return pending.pop()
+        while True:
+            pending[0].wait(0.1)
+            for i, async_result in enumerate(pending):
+                if async_result.ready():
+                    del pending[i]
+                    return async_result.get()
+            if set([ worker.pid for worker in pool._pool ]) != worker_pids:
+                raise Exception("A worker process of map_catalogs() died")
+
+    def diff(self, other):
+        """ Finds the directory entries that differ between this revision and
+            another one (of the same repository)
+            Both catalog trees are walked together. Nested catalogs with equal
+            hashes on both sides are skipped with their whole subtree, those
+            that differ are merge-joined on md5path. Entries whose owning
+            catalog changed (e.g. a new nested catalog) are matched by their
+            md5path across catalogs. Hence the cost is proportional to the
+            catalogs touched by the change, not to the repository.
+            Like RevisionIterator, a nested catalog mountpoint is represented
+            by the nested catalog's root entry. Differences only in the nested
+            catalog flags are ignored.
+            :return: generator of (DiffTypes.*, path, old dirent, new dirent)
+                     where the dirent of the missing side is None
+        """
+        unmatched   = {}  # md5path -> (revision, catalog hash, row)
+        old_mounts  = {}  # mountpoints not paired yet -> catalog hash
+        new_mounts  = {}
+        pairs       = [ (self.root_hash, other.root_hash) ]
+        while pairs or old_mounts or new_mounts:
+            if not pairs:
+                pairs.append(self._pop_shallowest_mountpoint(old_mounts,
+                                                             new_mounts))
+            old_hash, new_hash = pairs.pop()
+            if old_hash == new_hash:
+                continue
+            old_catalog = self._retrieve_pinned(old_hash)
+            new_catalog = other._retrieve_pinned(new_hash)
+            try:
+                self._pair_nested_catalogs(old_catalog, new_catalog, pairs,
+                                           old_mounts, new_mounts)
+                for change in self._diff_catalogs(other, old_catalog,
+                                                  new_catalog, unmatched):
+                    yield change
+            finally:
+                for revision, catalog in [ (self,  old_catalog),
+                                           (other, new_catalog) ]:
+                    if catalog is not None:
+                        revision.repository.unpin_catalog(catalog)
+        for change in self._unmatched_changes(other, unmatched):
+            yield change
+
+    def _retrieve_pinned(self, catalog_hash):
+        if catalog_hash is None:
+            return None
+        catalog = self.retrieve_catalog(catalog_hash)
+        self.repository.pin_catalog(catalog)
+        return catalog
+
+    @staticmethod
+    def _pair_nested_catalogs(old_catalog, new_catalog, pairs,
+                              old_mounts, new_mounts):
+        """ Pairs the nested catalogs of two catalogs by their mountpoints
+            Unpaired ones are kept, they might pair with a catalog found
+            deeper in the other tree later on (e.g. after a new mountpoint
+            was inserted above them).
+        """
+        for catalog, mounts, other_mounts, is_old in \
+                [ (old_catalog, old_mounts, new_mounts, True),
+                  (new_catalog, new_mounts, old_mounts, False) ]:
+            if catalog is None:
+                continue
+            for nested_ref in catalog.list_nested():
+                other_hash = other_mounts.pop(nested_ref.root_path, False)
+                if other_hash is False:
+                    mounts[nested_ref.root_path] = nested_ref.hash
+                elif is_old:
+                    pairs.append((nested_ref.hash, other_hash))
+                else:
+                    pairs.append((other_hash, nested_ref.hash))
+
+    @staticmethod
+    def _pop_shallowest_mountpoint(old_mounts, new_mounts):
+        """ Takes an unpaired catalog, preferring those close to the root as
+            their nested catalogs might pair with unpaired deeper ones
+        """
+        candidates = [ (path.count('/'), path, True)  for path in old_mounts ] + \
+                     [ (path.count('/'), path, False) for path in new_mounts ]
+        _, path, is_old = min(candidates)
+        if is_old:
+            return old_mounts.pop(path), None
+        return None, new_mounts.pop(path)
+
+    def _diff_catalogs(self, other, old_catalog, new_catalog, unmatched):
+        """ Merge-joins two catalogs on md5path and yields modified entries
+            Entries found on one side only are matched through unmatched
+        """
+        path_cache = {}
+        for old_row, new_row in self._merge_catalog_rows(old_catalog,
+                                                         new_catalog):
+            if old_row is not None and new_row is not None:
+                if self._rows_differ(old_row, new_row):
+                    yield self._make_change(DiffTypes.Modified, old_catalog,
+                                            old_row, new_catalog, new_row,
+                                            path_cache)
+                continue
+            if old_row is not None:
+                md5path, entry = old_row[:2], (self, old_catalog.hash, old_row)
+            else:
+                md5path, entry = new_row[:2], (other, new_catalog.hash, new_row)
+            counterpart = unmatched.get(md5path)
+            if counterpart is None or counterpart[0] is entry[0]:
+                unmatched[md5path] = entry
+                continue
+            del unmatched[md5path]
+            old_entry, new_entry = (entry, counterpart) \
+                                   if old_row is not None else \
+                                   (counterpart, entry)
+            if self._rows_differ(old_entry[2], new_entry[2]):
+                yield self._make_change(DiffTypes.Modified,
+                    self.retrieve_catalog(old_entry[1]), old_entry[2],
+                    other.retrieve_catalog(new_entry[1]), new_entry[2], {})
+
+    def _unmatched_changes(self, other, unmatched):
+        """ Yields the entries found in only one of the revisions """
+        by_catalog = collections.defaultdict(list)
+        for revision, catalog_hash, row in unmatched.itervalues():
+            by_catalog[(revision is self, catalog_hash)].append(row)
+        for (is_old, catalog_hash), rows in by_catalog.iteritems():
+            revision = self if is_old else other
+            catalog  = revision.retrieve_catalog(catalog_hash)
+            paths    = catalog.backtrace_paths_split_md5([ row[:2]
+                                                           for row in rows ])
+            for path, row in zip(paths, rows):
+                dirent = catalog._make_directory_entry(row)
+                if is_old:
+                    yield DiffTypes.Removed, path, dirent, None
+                else:
+                    yield DiffTypes.Added, path, None, dirent
+
+    @staticmethod
+    def _make_change(diff_type, old_catalog, old_row, new_catalog, new_row,
+                     path_cache):
+        path = new_catalog.backtrace_paths_split_md5([ new_row[:2] ],
+                                                     path_cache)[0]
+        return diff_type, path, old_catalog._make_directory_entry(old_row), \
+               new_catalog._make_directory_entry(new_row)
+
+    # flags that only tell if an entry is a nested catalog mountpoint or root
+    _nested_catalog_flags = _Flags.NestedCatalogMountpoint | \
+                            _Flags.NestedCatalogRoot
+
+    @staticmethod
+    def _rows_differ(old_row, new_row):
+        """ Compares two catalog rows (see DirectoryEntry.catalog_db_fields) """
+        nested_flags = Revision._nested_catalog_flags
+        return old_row[4] != new_row[4] or \
+               (old_row[5] & ~nested_flags) != (new_row[5] & ~nested_flags) or \
+               old_row[6:] != new_row[6:]
+
+    @staticmethod
+    def _merge_catalog_rows(old_catalog, new_catalog):
+        """ Full outer join of two catalogs on md5path in primary key order
+            :return: generator of (old row, new row), None for a missing side
+        """
+        old_rows = Revision._sorted_catalog_rows(old_catalog)
+        new_rows = Revision._sorted_catalog_rows(new_catalog)
+        old_row  = next(old_rows, None)
+        new_row  = next(new_rows, None)
+        while old_row is not None or new_row is not None:
+            if new_row is None or \
+               (old_row is not None and old_row[:2] < new_row[:2]):
+                yield old_row, None
+                old_row = next(old_rows, None)
+            elif old_row is None or new_row[:2] < old_row[:2]:
+                yield None, new_row
+                new_row = next(new_rows, None)
+            else:
+                yield old_row, new_row
+                old_row = next(old_rows, None)
+                new_row = next(new_rows, None)
+
+    @staticmethod
+    def _sorted_catalog_rows(catalog):
+        """ Rows of a catalog ordered by md5path, without mountpoint entries
+            (they are represented by the nested catalog's root entry)
+        """
+        if catalog is None:
+            return
+        for rows in catalog.run_sql_batches("SELECT " +
+                DirectoryEntry.catalog_db_fields() + "                      \
+                FROM catalog WHERE (flags & ?) = 0                          \
+                ORDER BY md5path_1, md5path_2;",
+                (_Flags.NestedCatalogMountpoint,)):
+            for row in rows:
+                yield row
+
+    def query_catalogs(self, sql, parameters = (), path = None,
+                       merge_sql = None):
+        """ Runs an SQL query across all catalogs of (a subtree of) a revision
+            The catalogs are attached to a single in-memory database, where
+            the temporary view 'catalog' combines their catalog tables with
+            UNION ALL. Next to the DirectoryEntry columns it provides the
+            columns catalog_hash and root_prefix of the owning catalog.
+            Filtering, sorting and aggregation are thus done by SQLite.
+            Beyond SQLite's attach limit the catalogs are queried in batches.
+            Then, merge_sql is required (MergeQueryRequired is raised
+            otherwise). It runs over the table 'results' that collects the
+            result rows of all batches, for example:
+              rev.query_catalogs("SELECT catalog_hash, md5path_1, md5path_2,
+                                         size FROM catalog WHERE flags & 4
+                                  ORDER BY size DESC LIMIT 1000",
+                                 path = "/sw",
+                                 merge_sql = "SELECT * FROM results
+                                              ORDER BY size DESC LIMIT 1000")
+            :param path: only query the entries below path (default: all
+                         catalogs). Unless path is a catalog's root, the
+                         view is restricted to path's subtree in the catalog
+                         containing it.
+            :return: list of result rows (of merge_sql if given)
+        """
+        db = sqlite3.connect(":memory:")
+        db.text_factory = str
+        try:
+            max_attached = _sqlite_max_attached()
+            catalogs     = self._catalogs_below(path)
+            batch        = self._pin_catalog_batch(catalogs, max_attached)
+            if merge_sql is None:
+                # results of several batches cannot be combined without it
+                next_batch = self._pin_catalog_batch(catalogs, 1)
+                if next_batch:
+                    for catalog, _ in batch + next_batch:
+                        self.repository.unpin_catalog(catalog)
+                    raise MergeQueryRequired(max_attached)
+                rows, _ = self._query_catalog_batch(db, batch, sql, parameters)
+                return rows
+            while batch:
+                rows, columns = self._query_catalog_batch(db, batch, sql,
+                                                          parameters)
+                self._store_results(db, columns, rows)
+                batch = self._pin_catalog_batch(catalogs, max_attached)
+            return db.execute(merge_sql).fetchall()
+        finally:
+            db.close()
+
+    def _catalogs_below(self, path):
+        """ Yields the catalog containing path and all catalogs nested below
+            as (catalog, md5path) tuples. md5path is the split md5 of path if
+            only path's subtree of the catalog is wanted, None otherwise.
+        """
+        real_path = self._normalize_path(_canonicalize_path(path or '/'))
+        catalog   = self.retrieve_catalog_for_path(real_path)
+        md5path   = None
+        if real_path != ('' if catalog.is_root() else catalog.root_prefix):
+            md5path = _split_md5_paths([ real_path ])[0]
+        catalog_hashes = []
+        while True:
+            for nested_ref in catalog.list_nested():
+                if nested_ref.root_path == real_path or \
+                   nested_ref.root_path.startswith(real_path + '/'):
+                    catalog_hashes.append(nested_ref.hash)
+            yield catalog, md5path
+            if not catalog_hashes:
+                break
+            catalog = self.retrieve_catalog(catalog_hashes.pop())
+            md5path = None
+
+    def _pin_catalog_batch(self, catalogs, batch_size):
+        """ Takes (and pins) the next batch_size catalogs from an iterator """
+        batch = []
+        for catalog, md5path in itertools.islice(catalogs, batch_size):
+            self.repository.pin_catalog(catalog)
+            batch.append((catalog, md5path))
+        return batch
+
+    def _query_catalog_batch(self, db, catalogs, sql, parameters):
+        """ Attaches (pinned) catalogs to db and runs sql on their union view
+            The catalogs are detached and unpinned afterwards
+        """
+        try:
+            selects = []
+            for i, (catalog, md5path) in enumerate(catalogs):
+                db.execute("ATTACH DATABASE ? AS clg" + str(i) + ";",
+                           (_attach_name_readonly(catalog._file.name),))
+                selects.append("SELECT " + DirectoryEntry.catalog_db_fields() +
+                               ", '" + catalog.hash.replace("'", "''") +
+                               "' AS catalog_hash, '" +
+                               catalog.root_prefix.replace("'", "''") +
+                               "' AS root_prefix FROM clg" + str(i) +
+                               ".catalog" +
+                               self._subtree_join("clg" + str(i), md5path))
+            db.execute("CREATE TEMP VIEW catalog AS " +
+                       " UNION ALL ".join(selects) + ";")
+            cursor  = db.execute(sql, parameters)
+            rows    = cursor.fetchall()
+            columns = [ column[0] for column in cursor.description or [] ]
+            return rows, columns
+        finally:
+            db.commit()
+            db.execute("DROP VIEW IF EXISTS temp.catalog;")
+            for i in range(len(selects)):
+                db.execute("DETACH DATABASE clg" + str(i) + ";")
+            for catalog, _ in catalogs:
+                self.repository.unpin_catalog(catalog)
+
+    @staticmethod
+    def _subtree_join(schema, md5path):
+        """ Restricts a catalog table to the subtree of md5path by joining it
+            with the subtree's md5 paths (collected along the parent index)
+        """
+        if md5path is None:
+            return ""
+        md5path_1, md5path_2 = md5path
+        return " JOIN (WITH RECURSIVE subtree(sub_1, sub_2) AS (" +          \
+               "SELECT md5path_1, md5path_2 FROM " + schema + ".catalog " +  \
+               "WHERE md5path_1 = " + str(md5path_1) +                       \
+               " AND md5path_2 = " + str(md5path_2) + " UNION ALL " +        \
+               "SELECT md5path_1, md5path_2 FROM " + schema + ".catalog " +  \
+               "JOIN subtree ON parent_1 = sub_1 AND parent_2 = sub_2) " +   \
+               "SELECT sub_1, sub_2 FROM subtree) " +                        \
+               "ON md5path_1 = sub_1 AND md5path_2 = sub_2"
+
+    @staticmethod
+    def _store_results(db, columns, rows):
+        """ Collects the result rows of a batch in the table 'results' """
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS results (" +
+                   ", ".join([ '"' + column.replace('"', '""') + '"'
+                               for column in columns ]) + ");")
+        db.executemany("INSERT INTO temp.results VALUES (" +
+                       ", ".join(["?"] * len(columns)) + ");", rows)
+        db.commit()
+
+    def walk(self, path, max_depth = None, **kwargs):
+        """ Iterates through the directory entries below path (see
+            RevisionIterator), starting in the catalog that contains it
+            Only nested catalogs mounted below path are fetched.
+            :param max_depth: directory levels to descend below path (0 yields
+                              the entry of path only). Nested catalogs beyond
+                              are not fetched, their mountpoint entry is
+                              yielded instead.
+        """
+        return RevisionIterator(self, path=path, max_depth=max_depth, **kwargs)
+
+    def walk_dirs(self, top, topdown = True, entries = False):
+        """ Directory tree generator in the manner of os.walk()
+            Yields a (dirpath, dirnames, filenames) tuple for every directory
+            below top. Every directory is listed by a single query on the md5
+            path of its parent and nested catalogs are entered transparently.
+            As with os.walk(), a top-down caller may prune dirnames in place.
+            :param entries: yield the DirectoryEntry objects of the files
+                            instead of their names
+        """
+        path    = self._normalize_path(top)
+        catalog = self.retrieve_catalog_for_path(path)
+        dirent  = catalog.find_directory_entry(path)
+        if not dirent or not dirent.is_directory():
+            return
+        self.repository.pin_catalog(catalog)
+        # pending directories are (path, pinned catalog, None, md5path) or
+        # (path, None, nested catalog hash, md5path) for nested catalogs that
+        # are retrieved once they are due, postponed bottom-up results are
+        # (None, None, None, result, None)
+        stack   = [ (path, catalog, None, dirent.md5path_1, dirent.md5path_2) ]
+        current = None
+        try:
+            while stack:
+                dir_path, current, nested_hash, md5path_1, md5path_2 = \
+                    stack.pop()
+                if dir_path is None:
+                    yield md5path_1
+                    continue
+                if current is None:
+                    current = self._retrieve_pinned(nested_hash)
+                catalog = current
+                dirnames, filenames, subdirs = \
+                    self._split_directory(catalog, md5path_1, md5path_2, entries)
+                if topdown:
+                    yield (dir_path or '/'), dirnames, filenames
+                else:
+                    stack.append((None, None, None,
+                                  ((dir_path or '/'), dirnames, filenames),
+                                  None))
+                for name in reversed(dirnames):
+                    subdir = subdirs.get(name)
+                    if subdir is None:
+                        continue
+                    subdir_path = dir_path + '/' + name
+                    if subdir.is_nested_catalog_mountpoint():
+                        nested_ref = catalog.find_nested_for_path(subdir_path)
+                        self._mount_table[subdir_path] = nested_ref.hash
+                        stack.append((subdir_path, None, nested_ref.hash,
+                                      subdir.md5path_1, subdir.md5path_2))
+                    else:
+                        self.repository.pin_catalog(catalog)
+                        stack.append((subdir_path, catalog, None,
+                                      subdir.md5path_1, subdir.md5path_2))
+                current = None
+                self.repository.unpin_catalog(catalog)
+        finally:
+            if current is not None:
+                self.repository.unpin_catalog(current)
+            for _, catalog, _, _, _ in stack:
+                if catalog is not None:
+                    self.repository.unpin_catalog(catalog)
+
+    @staticmethod
+    def _split_directory(catalog, md5path_1, md5path_2, entries):
+        """ Lists a directory as subdirectory names and file names (or
+            DirectoryEntry objects) plus the subdirectory entries by name
+        """
+        dirnames, filenames, subdirs = [], [], {}
+        for dirent in catalog.list_directory_split_md5(md5path_1, md5path_2):
+            if dirent.is_directory():
+                dirnames.append(dirent.name)
+                subdirs[dirent.name] = dirent
+            else:
+                filenames.append(dirent if entries else dirent.name)
+        return dirnames, filenames, subdirs
 
     def retrieve_catalog_for_path(self, needle_path):
         """
         Recursively walk down the Catalogs and find the best fit for a path
+        The walk starts at the deepest catalog mountpoint already known for
+        the path, so repeated lookups in the same subtree go straight to the
+        right catalog.
         """
-        clg = self.retrieve_root_catalog()
+        path = self._normalize_path(needle_path)
+        clg  = self.retrieve_catalog(self._find_known_catalog_hash(path))
         while True:
-            new_nested_reference = clg.find_nested_for_path(needle_path)
-            if new_nested_reference is None:
+            nested_reference = clg.find_nested_for_path(path)
+            if nested_reference is None:
                 break
-            nested_reference = new_nested_reference
+            self._mount_table[nested_reference.root_path] = nested_reference.hash
             clg = self.retrieve_catalog(nested_reference.hash)
         return clg
 
+    def _find_known_catalog_hash(self, path):
+        """ Longest prefix match of path in the mount table """
+        mountpoint = path
+        while mountpoint not in self._mount_table:
+            mountpoint = mountpoint[:mountpoint.rfind('/')]
+        return self._mount_table[mountpoint]
+
+    @staticmethod
+    def _normalize_path(path):
+        real_path = _canonicalize_path(path)
+        return '' if real_path == '/' else real_path
+
     def lookup(self, path):
         """
         Lookups in all existing catalogs for this path's best fit
@@ -183,11 +1263,51 @@ class Revision:
         :return: the DirectoryEntry that corresponds to the given path if
         it is found in the already loaded catalogs, or None otherwise
         """
-        if path == '/':
-            path = ''
+        path = self._normalize_path(path)
         best_fit = self.retrieve_catalog_for_path(path)
         return best_fit.find_directory_entry(path)
 
+    def lookup_many(self, paths, batch_size=10000):
+        """
+        Looks up many paths at once
+        Paths are processed in batches. Inside a batch they are grouped by
+        their owning catalog, which answers them with a few set-based queries.
+        :param paths: iterable of paths to search for
+        :param batch_size: number of paths resolved per batch
+        :return: a generator yielding the DirectoryEntry (or None if not
+        found) for every given path in input order
+        """
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= batch_size:
+                for dirent in self._lookup_batch(batch):
+                    yield dirent
+                batch = []
+        for dirent in self._lookup_batch(batch):
+            yield dirent
+
+    def _lookup_batch(self, paths):
+        real_paths = [ self._normalize_path(path) for path in paths ]
+        md5paths   = _split_md5_paths(real_paths)
+        catalogs        = {}
+        md5paths_by_clg   = collections.defaultdict(list)
+        try:
+            for path, md5path in zip(real_paths, md5paths):
+                clg = self.retrieve_catalog_for_path(path)
+                if clg.hash not in catalogs:
+                    self.repository.pin_catalog(clg)
+                    catalogs[clg.hash] = clg
+                md5paths_by_clg[clg.hash].append(md5path)
+            dirents = {}
+            for clg_hash, clg_md5paths in md5paths_by_clg.iteritems():
+                clg = catalogs[clg_hash]
+                dirents.update(clg.find_directory_entries_split_md5(clg_md5paths))
+        finally:
+            for clg in catalogs.values():
+                self.repository.unpin_catalog(clg)
+        return [ dirents.get(md5path) for md5path in md5paths ]
+
     def list_directory(self, path):
         """
         List all the entries in a directory
@@ -195,7 +1315,30 @@ class Revision:
         :return: a list of DirectoryEntry representing all the entries for the
         given directory, or None if such a directory does not exist
         """
-        dirent = self.lookup(path)
+        path = self._normalize_path(path)
+        best_fit = self.retrieve_catalog_for_path(path)
+        dirent = best_fit.find_directory_entry(path)
         if dirent and dirent.is_directory():
-            best_fit = self.retrieve_catalog_for_path(path)
-            return best_fit.list_directory(path)
+            return list(best_fit.list_directory_split_md5(dirent.md5path_1,
+                                                          dirent.md5path_2))
+
+
+# repository of a map_catalogs() worker process (see _init_map_worker)
+_map_repository = None
+
+def _init_map_worker(source, cache_dir):
+    global _map_repository
+    from repository import Repository # circular import
+    _map_repository = Repository.from_source(source, cache_dir)
+
+def _map_catalog(catalog_hash, map_fn):
+    """ Runs in a worker process, exceptions are passed back as traceback """
+    try:
+        catalog = _map_repository.retrieve_catalog(catalog_hash)
+        try:
+            return (catalog_hash, map_fn(catalog),
+                    [ ref.hash for ref in catalog.list_nested() ], None)
+        finally:
+            _map_repository.close_catalog(catalog)
+    except Exception:
+        return catalog_hash, None, None, traceback.format_exc()
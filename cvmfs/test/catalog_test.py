@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This file is part of the CernVM File System auxiliary tools.
+"""
+
+import functools
+import sqlite3
+import threading
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import cvmfs
+from cvmfs.catalog   import CatalogIterator
+from file_sandbox    import FileSandbox
+from mock_repository import MockRepository
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.sandbox   = FileSandbox("py_ut_catalog_")
+        self.mock_repo = MockRepository()
+        self.repo = cvmfs.open_repository(self.mock_repo.dir)
+        self.revision = self.repo.get_current_revision()
+
+    def tearDown(self):
+        del self.mock_repo
+
+
+    def test_readonly_database(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        self.assertRaises(sqlite3.DatabaseError, root_catalog.run_sql,
+                          "DELETE FROM catalog;")
+        self.assertTrue(root_catalog.find_directory_entry('/bar') is not None)
+
+
+    def test_connection_pragmas(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        cache_size = root_catalog.run_sql("PRAGMA cache_size;")[0][0]
+        temp_store = root_catalog.run_sql("PRAGMA temp_store;")[0][0]
+        self.assertEqual(cvmfs.catalog.Catalog.cache_size, cache_size)
+        self.assertEqual(2, temp_store) # MEMORY
+
+
+    def test_thread_local_connections(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        all_started  = threading.Event()
+        results      = {}
+        def lookup(thread_num):
+            dirent = root_catalog.find_directory_entry('/bar/hello_world')
+            results[thread_num] = (dirent.name, root_catalog._get_db_handle())
+            all_started.wait()
+        threads = [ threading.Thread(target=lookup, args=(i,))
+                    for i in range(4) ]
+        for t in threads:
+            t.start()
+        all_started.set()
+        for t in threads:
+            t.join()
+        handles = set([ id(handle) for _, handle in results.values() ])
+        self.assertEqual(4, len(handles))
+        for name, _ in results.values():
+            self.assertEqual('hello_world', name)
+        # connections of finished threads are reclaimed
+        root_catalog._close_orphaned_handles()
+        self.assertEqual(1, len(root_catalog._db_handles))
+
+
+    def test_find_nested_for_path(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        self.assertEqual('/bar/3', root_catalog.find_nested_for_path(
+                                                    '/bar/3/1/bar').root_path)
+        self.assertEqual('/bar/3', root_catalog.find_nested_for_path(
+                                                    '/bar/3').root_path)
+        self.assertEqual('/foo', root_catalog.find_nested_for_path(
+                                                    '/foo/').root_path)
+        self.assertIsNone(root_catalog.find_nested_for_path('/bar/30'))
+        self.assertIsNone(root_catalog.find_nested_for_path('/bar'))
+        self.assertIsNone(root_catalog.find_nested_for_path(''))
+        self.assertIsNone(root_catalog.find_best_child_for_path('/bar/10'))
+        self.assertEqual(5, root_catalog.nested_count())
+
+
+    def test_backtrace_content_hash(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        hello_world  = 'ff049c626904064d641feca0e9936e5b211807c6'
+        self.assertEqual(['/bar/hello_world'],
+                         root_catalog.backtrace_content_hash(hello_world))
+        self.assertEqual(['/bar/hello_world'],
+                         root_catalog.backtrace_content_hash(hello_world.upper()))
+        self.assertEqual([], root_catalog.backtrace_content_hash(
+                                                    hello_world + '-rmd160'))
+        self.assertEqual([], root_catalog.backtrace_content_hash('00' * 20))
+        nested_catalog = self.revision.retrieve_catalog_for_path('/bar/3')
+        self.assertEqual(['/bar/3/1/bar', '/bar/3/2/bar', '/bar/3/3/bar'],
+                         sorted(nested_catalog.backtrace_content_hash(
+                            'c5baca6f42d65e4a21dc9bad66dea5152ab813d8')))
+
+
+    def test_content_hash_index(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir,
+                                     cache_dir=self.sandbox.temporary_dir)
+        root_catalog = repo.get_current_revision().retrieve_root_catalog()
+        hash_index = repo.retrieve_content_hash_index(root_catalog)
+        for dirent_path in [ '/bar/hello_world', '/.cvmfsdirtab' ]:
+            dirent = root_catalog.find_directory_entry(dirent_path)
+            self.assertEqual([dirent_path], root_catalog.backtrace_content_hash(
+                                                    dirent.content_hash,
+                                                    hash_index))
+        # the file chunks of /bar/big
+        big = root_catalog.find_directory_entry('/bar/big')
+        self.assertTrue(big.has_chunks())
+        for chunk in big.chunks:
+            self.assertEqual(['/bar/big'], root_catalog.backtrace_content_hash(
+                                                    chunk.content_hash_string(),
+                                                    hash_index))
+        index_path = hash_index._file.name
+        self.assertTrue(index_path.startswith(self.sandbox.temporary_dir))
+        self.assertEqual(index_path,
+            repo.retrieve_content_hash_index(root_catalog)._file.name)
+
+
+    def test_backtrace_paths(self):
+        catalog = self.revision.retrieve_catalog_for_path('/bar/3')
+        paths = [ '/bar/3/1/bar', '/bar/3/2', '/bar/3', '/bar/3/3/bar' ]
+        md5paths = [ catalog.find_directory_entry(path).path_hash()
+                     for path in paths ]
+        for path, md5path in zip(paths, md5paths):
+            self.assertEqual(path, catalog.backtrace_path_split_md5(*md5path))
+        path_cache = {}
+        self.assertEqual(paths, catalog.backtrace_paths_split_md5(
+                                    md5paths + [ (1, 2) ], path_cache)[:-1])
+        self.assertIsNone(catalog.backtrace_paths_split_md5([ (1, 2) ])[0])
+        self.assertEqual('/bar/3/1', path_cache[catalog.find_directory_entry(
+                                        '/bar/3/1').path_hash()])
+        root_catalog = self.revision.retrieve_root_catalog()
+        self.assertEqual(['/bar/big', '/', '/bar/3'],
+            root_catalog.backtrace_paths_split_md5([
+                root_catalog.find_directory_entry(path).path_hash()
+                for path in [ '/bar/big', '', '/bar/3' ] ], path_cache))
+
+
+    @unittest.skipIf(numpy is None, "requires NumPy")
+    def test_export_columns(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        columns = root_catalog.export_columns(batch_size=4)
+        num_rows = root_catalog.run_sql("SELECT count(*) FROM catalog;")[0][0]
+        for array in columns.values():
+            self.assertEqual(num_rows, len(array))
+        big = root_catalog.find_directory_entry('/bar/big')
+        row = numpy.flatnonzero(columns['md5path_1'] == big.md5path_1)[0]
+        self.assertEqual(big.size, columns['size'][row])
+        self.assertEqual(big.flags, columns['flags'][row])
+        self.assertEqual(big.content_hash_type, columns['hash_type'][row])
+        self.assertEqual(len(big.chunks), columns['chunks'][row])
+        self.assertEqual(len(big.chunks), columns['chunks'].sum())
+
+        revision_columns = self.revision.export_columns()
+        self.assertEqual(len(list(self.repo)), len(revision_columns['size']))
+
+
+    def test_directory_entry(self):
+        root_catalog = self.revision.retrieve_root_catalog()
+        dirent = root_catalog.find_directory_entry('/bar/hello_world')
+        self.assertFalse(hasattr(dirent, '__dict__'))
+        self.assertEqual('ff049c626904064d641feca0e9936e5b211807c6',
+                         dirent.content_hash)
+        self.assertEqual(dirent.content_hash, dirent.content_hash_string())
+        self.assertEqual(cvmfs.ContentHashTypes.Sha1, dirent.content_hash_type)
+        self.assertFalse(dirent.has_chunks())
+        content = dirent.retrieve_from(self.repo)
+        self.assertTrue(len(content.read()) > 0)
+        directory = root_catalog.find_directory_entry('/bar')
+        self.assertIsNone(directory.content_hash)
+        for flags, hash_type in [ (4, cvmfs.ContentHashTypes.Sha1),
+                                  (4 + 256, cvmfs.ContentHashTypes.Ripemd160),
+                                  (4 + 512, cvmfs.ContentHashTypes.Unknown) ]:
+            self.assertEqual(hash_type, cvmfs.ContentHashTypes.from_flags(flags))
+
+
+    def test_close(self):
+        root_hash = self.revision.root_hash
+        with self.repo.retrieve_object(root_hash, 'C') as catalog_file:
+            with cvmfs.Catalog(catalog_file, root_hash) as catalog:
+                self.assertFalse(catalog.closed)
+                self.assertTrue(catalog.find_directory_entry('/bar') is not None)
+            self.assertTrue(catalog.closed)
+            self.assertTrue(catalog_file.closed)
+            self.assertEqual({}, catalog._db_handles)
+            self.assertRaises(sqlite3.ProgrammingError,
+                              catalog.find_directory_entry, '/bar')
+            catalog.close()
+        history = self.repo.retrieve_history()
+        history.close()
+        history.close()
+        self.assertTrue(history.closed)
+
+
+    def test_computed_statistics(self):
+        for catalog in self.revision.catalogs():
+            stored   = catalog.get_statistics()
+            computed = catalog.get_statistics(computed=True)
+            self.assertFalse(computed.has_subtree_statistics())
+            for counter in stored.counters:
+                self.assertEqual(getattr(stored, counter),
+                                 getattr(computed, counter))
+
+
+    def test_subtree_statistics(self):
+        root_hash = self.revision.root_hash
+        stored    = self.revision.retrieve_root_catalog().get_statistics()
+        catalogs  = list(self.revision.catalogs())
+        for catalog in catalogs: # pretend catalogs without statistics table
+            catalog.get_statistics = functools.partial(
+                cvmfs.Catalog.get_statistics, catalog, computed=True)
+        computed = self.repo.get_subtree_statistics(root_hash)
+        self.assertEqual(stored.get_all_fields(), computed.get_all_fields())
+        self.assertEqual(stored.num_subtree_entries(),
+                         computed.num_subtree_entries())
+        self.assertEqual(len(catalogs), len(self.repo._subtree_statistics))
+        self.assertTrue(computed is self.repo.get_subtree_statistics(root_hash))
+
+
+    def test_compact_iteration(self):
+        for catalog in self.revision.catalogs():
+            expected = [ (path, dirent.md5path_1, dirent.md5path_2)
+                         for path, dirent in CatalogIterator(catalog) ]
+            compact  = CatalogIterator(catalog, compact=True)
+            self.assertEqual(expected, [ (path, dirent.md5path_1,
+                                          dirent.md5path_2)
+                                         for path, dirent in compact ])
+            compact = CatalogIterator(catalog, compact=True)
+            head    = [ next(compact)[0] for _ in range(2) ]
+            self.assertTrue(all([ isinstance(entry, tuple) and len(entry) == 3
+                                  for entry in compact.backlog ]))
+            resumed = CatalogIterator(catalog, backlog=compact.get_backlog())
+            self.assertEqual(expected, [ entry for entry in expected
+                                         if entry[0] in head ] +
+                                       [ (path, dirent.md5path_1,
+                                          dirent.md5path_2)
+                                         for path, dirent in resumed ])
@@ -30,3 +30,25 @@ class TestMD5Handling(unittest.TestCase):
         path_md5 = hashlib.md5(self.path)
         self.assertEqual(path_md5.digest(), digest)
 
+
+    def test_md5_combination_unsigned(self):
+        digest = cvmfs._combine_md5(self.path_md5_lo,
+                                    self.path_md5_hi + 2**64)
+        path_md5 = hashlib.md5(self.path)
+        self.assertEqual(path_md5.digest(), digest)
+
+
+    def test_md5_round_trip(self):
+        for path in [ '', '/', '/bar', self.path ]:
+            digest = hashlib.md5(path).digest()
+            self.assertEqual(digest, cvmfs._combine_md5(*cvmfs._split_md5(digest)))
+
+
+    def test_md5_batch_splitting(self):
+        paths = [ self.path, '', '/bar', self.path ]
+        md5s  = cvmfs._split_md5_paths(paths)
+        self.assertEqual(len(paths), len(md5s))
+        self.assertEqual((self.path_md5_lo, self.path_md5_hi), md5s[0])
+        for path, md5 in zip(paths, md5s):
+            self.assertEqual(cvmfs._split_md5(hashlib.md5(path).digest()), md5)
+        self.assertEqual([], cvmfs._split_md5_paths([]))
@@ -5,13 +5,37 @@ Created by René Meusel
 This file is part of the CernVM File System auxiliary tools.
 """
 
+import collections
+import itertools
+import operator
+import os
+import sqlite3
+import time
 import unittest
 
 import cvmfs
+from cvmfs.dirent    import DirectoryEntry
 from file_sandbox    import FileSandbox
 from mock_repository import MockRepository
 
 
+def _count_entries(catalog):
+    return len(list(catalog))
+
+def _fail_on_nested(catalog):
+    if not catalog.is_root():
+        raise ValueError("nested catalog")
+    return 0
+
+def _unpicklable_result(catalog):
+    return lambda: catalog.hash
+
+def _exit_on_nested(catalog):
+    if not catalog.is_root():
+        os._exit(1)
+    return 0
+
+
 class TestRepositoryWrapper(unittest.TestCase):
     def setUp(self):
         self.sandbox = FileSandbox("py_ut_repo_")
@@ -171,3 +195,613 @@ class TestRepositoryWrapper(unittest.TestCase):
                 self.assertIsNone(catalog
                                   .find_nested_for_path('/bar/4/foo'))
                 break
+        # catalogs of iterations left early must not stay pinned
+        self.assertEqual({}, repo._pinned_catalogs)
+        catalogs = rev.catalogs()
+        next(catalogs)
+        next(catalogs)
+        self.assertEqual(1, len(repo._pinned_catalogs))
+        del catalogs
+        self.assertEqual({}, repo._pinned_catalogs)
+        iterator = cvmfs.RevisionIterator(rev)
+        for path, _ in iterator:
+            if path.startswith('/bar/3/'):
+                break
+        self.assertEqual(2, len(repo._pinned_catalogs))
+        del iterator
+        self.assertEqual({}, repo._pinned_catalogs)
+
+    def test_revision_by_tag_name(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_revision('trunk-previous')
+        self.assertEqual(2, rev.revision_number)
+        self.assertEqual('trunk-previous', rev.name)
+        history = repo.retrieve_history()
+        self.assertIsNone(history.get_tag_by_name("x' OR name='trunk"))
+
+    def test_mount_table(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        self.assertIsNotNone(rev.lookup('/bar/3/1/bar'))
+        self.assertEqual(rev.retrieve_catalog_for_path('/bar/3').hash,
+                         rev._mount_table['/bar/3'])
+        self.assertEqual(rev.root_hash, rev._find_known_catalog_hash('/bar/1'))
+        self.assertEqual(rev._mount_table['/bar/3'],
+                         rev._find_known_catalog_hash('/bar/3/2/bar'))
+        self.assertEqual('/bar/3', rev.retrieve_catalog_for_path('/bar/3/2')
+                                      .root_prefix)
+        self.assertEqual('/', rev.retrieve_catalog_for_path('/bar').root_prefix)
+
+    def test_lookup_many(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        paths = [ '/bar/4/foo', '/bar/4/foobar', '/', '/bar/3/1/bar',
+                  '/bar/3', '/.cvmfsdirtab', '/bar/4/foo/', '/nope' ]
+        dirents = list(rev.lookup_many(paths, batch_size=3))
+        self.assertEqual(len(paths), len(dirents))
+        for path, dirent in zip(paths, dirents):
+            expected = rev.lookup(path)
+            if expected is None:
+                self.assertIsNone(dirent)
+            else:
+                self.assertEqual(expected.path_hash(), dirent.path_hash())
+                self.assertEqual(expected.flags, dirent.flags)
+        self.assertEqual([], list(rev.lookup_many([])))
+
+    def test_content_index(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        index_path = os.path.join(self.sandbox.temporary_dir, 'content.index')
+        index = cvmfs.RepositoryContentIndex(index_path)
+        for revision_number in [ 1, 2, 3 ]:
+            index.add_revision(repo.get_revision(revision_number))
+        index.close()
+
+        index = cvmfs.RepositoryContentIndex(index_path)
+        current = repo.get_current_revision()
+        self.assertTrue(index.has_catalog(current.root_hash))
+        for catalog in current.catalogs():
+            self.assertTrue(index.has_catalog(catalog.hash))
+        # already indexed, no catalog is retrieved again
+        fresh_repo = cvmfs.open_repository(self.mock_repo.dir)
+        fresh = fresh_repo.get_current_revision()
+        def fail_retrieve(catalog_hash):
+            self.fail("retrieved " + catalog_hash)
+        fresh.retrieve_catalog = fail_retrieve
+        index.add_revision(fresh)
+        self.assertEqual(0, len(fresh_repo._opened_catalogs))
+
+        hello_world = current.lookup('/bar/hello_world')
+        usages = index.find(hello_world.content_hash)
+        self.assertTrue((None, '/bar/hello_world', 3) in usages)
+        self.assertEqual([], index.find(hello_world.content_hash + '-rmd160'))
+        self.assertEqual(3, len([ path for _, path, revision in
+                                  index.find('c5baca6f42d65e4a21dc9bad66dea5152ab813d8')
+                                  if revision == 3 ]))
+        big = current.lookup('/bar/big')
+        for chunk in big.chunks:
+            self.assertTrue((chunk.offset, '/bar/big', 3) in
+                            index.find(chunk.content_hash_string()))
+
+    def test_catalog_cache_bounds(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        repo.max_open_catalogs = 2
+        rev = repo.get_current_revision()
+        root = rev.retrieve_root_catalog()
+        repo.pin_catalog(root)
+        catalogs = [ ref.retrieve_from(repo) for ref in root.list_nested() ]
+        self.assertEqual(2, len(repo._opened_catalogs))
+        self.assertTrue(root.hash in repo._opened_catalogs)
+        self.assertTrue(catalogs[-1].hash in repo._opened_catalogs)
+        # evicted catalogs are closed right away, only cached ones hold files
+        def assert_only_cached_open():
+            for catalog in catalogs + [ root ]:
+                self.assertFalse(catalog.closed)
+                self.assertEqual(catalog.hash in repo._opened_catalogs,
+                                 catalog._file is not None)
+        assert_only_cached_open()
+        # ... and reopen themselves (back into the cache) when used again
+        evicted = catalogs[0]
+        self.assertTrue(evicted.find_directory_entry(evicted.root_prefix)
+                        is not None)
+        self.assertTrue(repo._opened_catalogs.get(evicted.hash) is evicted)
+        self.assertTrue(repo.retrieve_catalog(evicted.hash) is evicted)
+        self.assertEqual(2, len(repo._opened_catalogs))
+        assert_only_cached_open()
+        self.assertTrue(rev.lookup('/bar/3/1/bar') is not None)
+        assert_only_cached_open()
+
+        repo.unpin_catalog(root)
+        repo.max_open_catalogs     = 1024
+        repo.max_open_catalog_size = 1
+        reopened = repo.retrieve_catalog(catalogs[1].hash)
+        self.assertTrue(reopened is catalogs[1])
+        self.assertEqual([ reopened.hash ], repo._opened_catalogs.keys())
+        self.assertEqual(reopened.db_size(), repo._opened_catalogs_size)
+        assert_only_cached_open()
+
+        repo.close()
+        self.assertTrue(all([ catalog.closed for catalog in catalogs ]))
+        self.assertTrue(root.closed)
+        self.assertRaises(sqlite3.ProgrammingError, evicted.find_directory_entry,
+                          evicted.root_prefix)
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        repo.max_open_catalogs = 1
+        rev = repo.get_current_revision()
+        dirents = list(rev.lookup_many([ '/bar/3/1/bar', '/bar/4/foo',
+                                         '/bar/hello_world' ]))
+        self.assertTrue(all([ dirent is not None for dirent in dirents ]))
+        self.assertEqual({}, repo._pinned_catalogs)
+        self.assertTrue(rev.retrieve_root_catalog().find_directory_entry('/bar')
+                        is not None)
+
+    def test_catalog_cache_iteration(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        expected = [ path for path, _ in repo ]
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        repo.max_open_catalogs = 1
+        self.assertEqual(expected, [ path for path, _ in repo ])
+        self.assertEqual({}, repo._pinned_catalogs)
+        self.assertEqual(1, len(repo._opened_catalogs))
+
+    def test_close_catalog(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        catalog = repo.get_current_revision().retrieve_root_catalog()
+        repo.close_catalog(catalog)
+        self.assertTrue(catalog._file.closed)
+        self.assertEqual(0, len(repo._opened_catalogs))
+        self.assertEqual(0, repo._opened_catalogs_size)
+
+    def test_close_repository(self):
+        with cvmfs.open_repository(self.mock_repo.dir) as repo:
+            iterator = iter(repo)
+            iterator.next()
+            catalogs = repo._opened_catalogs.values()
+            self.assertNotEqual({}, repo._pinned_catalogs)
+            iterator.close()
+            self.assertEqual({}, repo._pinned_catalogs)
+            self.assertRaises(StopIteration, iterator.next)
+        self.assertEqual(0, len(repo._opened_catalogs))
+        for catalog in catalogs:
+            self.assertTrue(catalog.closed)
+
+    def test_query_catalogs(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        entries = [ (clg.hash, dirent.name, dirent.size)
+                    for clg in rev.catalogs() for _, dirent in clg
+                    if dirent.is_file() ]
+        top_3 = [ size for _, _, size in
+                  sorted(entries, key=lambda e: e[2], reverse=True)[:3] ]
+        top_3_sql = "SELECT catalog_hash, name, size FROM catalog    \
+                     WHERE flags & ? ORDER BY size DESC LIMIT 3"
+        merge_sql = "SELECT * FROM results ORDER BY size DESC LIMIT 3"
+
+        max_attached = cvmfs.revision._sqlite_max_attached
+        catalog_count = len(list(rev.catalogs()))
+        for attach_limit in [ max_attached(), 2 ]:
+            cvmfs.revision._sqlite_max_attached = lambda: attach_limit
+            try:
+                # more catalogs than can be attached at once need a merge query
+                merge_all = None
+                if attach_limit < catalog_count:
+                    merge_all = "SELECT * FROM results"
+                    self.assertRaises(cvmfs.MergeQueryRequired,
+                                      rev.query_catalogs, top_3_sql, (4,))
+                self.assertEqual(sorted(entries), sorted(rev.query_catalogs(
+                    "SELECT catalog_hash, name, size FROM catalog \
+                     WHERE flags & 4;", merge_sql=merge_all)))
+                result = rev.query_catalogs(top_3_sql, (4,),
+                                            merge_sql=merge_sql)
+                self.assertEqual(top_3, [ size for _, _, size in result ])
+                self.assertEqual([ ('/bar/3', 4) ], rev.query_catalogs(
+                    "SELECT root_prefix, count(*) FROM catalog \
+                     WHERE flags & 4 GROUP BY root_prefix;", path='/bar/3/'))
+                self.assertEqual(5, len(rev.query_catalogs(
+                    "SELECT DISTINCT catalog_hash FROM catalog;",
+                    path='/bar', merge_sql=merge_all)))
+                # paths that are no catalog mountpoint restrict the view
+                for path in [ '/bar', '/bar/3/1', '/bar/hello_world', '/' ]:
+                    expected = set([ (dirent.md5path_1, dirent.md5path_2)
+                                     for _, dirent in rev.walk(path) ])
+                    self.assertEqual(expected, set(rev.query_catalogs(
+                        "SELECT md5path_1, md5path_2 FROM catalog;",
+                        path=path, merge_sql=merge_all)))
+                self.assertEqual([], rev.query_catalogs(
+                    "SELECT name FROM catalog;", path='/bar/nope'))
+            finally:
+                cvmfs.revision._sqlite_max_attached = max_attached
+        self.assertEqual({}, repo._pinned_catalogs)
+
+    def test_parallel_revision_iterator(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        expected = [ (path, dirent.flags) for path, dirent in
+                     cvmfs.RevisionIterator(rev) ]
+        for workers in [ 1, 3 ]:
+            for batch_size in [ 1, 1000 ]:
+                ordered = cvmfs.ParallelRevisionIterator(rev, workers,
+                                                         ordered=True,
+                                                         batch_size=batch_size)
+                self.assertEqual(expected, [ (path, dirent.flags)
+                                             for path, dirent in ordered ])
+                unordered = cvmfs.ParallelRevisionIterator(rev, workers,
+                                                           batch_size=batch_size)
+                self.assertEqual(sorted(expected),
+                                 sorted([ (path, dirent.flags)
+                                          for path, dirent in unordered ]))
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        for workers in [ 1, 3 ]:
+            ordered = cvmfs.ParallelRevisionIterator(rev, workers, ordered=True,
+                                                     batch_size=1,
+                                                     max_buffered_batches=1)
+            buffered = []
+            walked   = []
+            for path, dirent in ordered:
+                time.sleep(0.001) # let the workers run ahead
+                # catalogs being yielded may exceed the limit by two batches
+                # (the one needed next and the rest of a split batch)
+                buffered.append(ordered._buffered -
+                                2 * len(ordered._emit_stack))
+                walked.append((path, dirent.flags))
+            self.assertEqual(expected, walked)
+            self.assertTrue(max(buffered) <= 1)
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        with cvmfs.ParallelRevisionIterator(rev, 2, batch_size=1) as iterator:
+            iterator.next()
+        self.assertEqual([], iterator._workers)
+
+    def test_parallel_revision_iterator_error(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        rev._tag.hash = '0' * 40
+        iterator = cvmfs.ParallelRevisionIterator(rev, 2)
+        self.assertRaises(cvmfs.FileNotFoundInRepository, list, iterator)
+        self.assertEqual([], iterator._workers)
+
+    def test_catalog_prefetcher(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        expected_paths    = [ path for path, _ in cvmfs.RevisionIterator(rev) ]
+        expected_catalogs = [ clg.hash for clg in rev.catalogs() ]
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        repo.max_open_catalogs = 2
+        rev = repo.get_current_revision()
+        for threads, max_pending in [ (1, 1), (4, 16) ]:
+            with cvmfs.CatalogPrefetcher(repo, threads, max_pending) as pf:
+                self.assertEqual(expected_paths,
+                                 [ path for path, _ in
+                                   cvmfs.RevisionIterator(rev, prefetcher=pf) ])
+                self.assertEqual(expected_catalogs,
+                                 [ clg.hash for clg in rev.catalogs(pf) ])
+                self.assertEqual(0, pf._window_count)
+            self.assertEqual({}, repo._pinned_catalogs)
+
+        with cvmfs.CatalogPrefetcher(repo, 1, 1) as pf:
+            prefetched = []
+            retrieved  = []
+            prefetch = pf.prefetch
+            retrieve = pf.retrieve
+            def record_prefetch(refs):
+                prefetched.extend([ ref.root_path for ref in refs ])
+                prefetch(refs)
+            def record_retrieve(ref):
+                retrieved.append(ref.root_path)
+                return retrieve(ref)
+            pf.prefetch = record_prefetch
+            pf.retrieve = record_retrieve
+            list(cvmfs.RevisionIterator(rev, prefetcher=pf))
+        self.assertEqual([ '/foo', '/bar/4', '/bar/3', '/bar/2', '/bar/1' ],
+                         retrieved)
+        self.assertEqual(retrieved, prefetched)
+
+        root = rev.retrieve_root_catalog()
+        self.assertEqual([ 14336 ] * 5, [ ref.size for ref in root.list_nested() ])
+        with cvmfs.CatalogPrefetcher(repo, 2, max_pending_size=20000) as pf:
+            pf.prefetch(root.list_nested())
+            for ref in reversed(root.list_nested()):
+                catalog = pf.retrieve(ref)
+                self.assertEqual(ref.hash, catalog.hash)
+                self.assertFalse(catalog.closed)
+                self.assertTrue(pf._window_count <= 1)
+                repo.unpin_catalog(catalog)
+        self.assertEqual({}, repo._pinned_catalogs)
+
+    def test_map_catalogs(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        current  = repo.get_current_revision()
+        previous = repo.get_revision(2)
+        for rev in [ current, previous ]:
+            expected = sum([ _count_entries(clg) for clg in rev.catalogs() ])
+            for workers in [ 1, 2 ]:
+                self.assertEqual(expected, rev.map_catalogs(_count_entries,
+                                                            operator.add, 0,
+                                                            workers))
+
+        memo = {}
+        current.map_catalogs(_count_entries, operator.add, 0, 2, memo)
+        current_hashes = set([ clg.hash for clg in current.catalogs() ])
+        self.assertEqual(current_hashes, set(memo.keys()))
+        previous_hashes = set([ clg.hash for clg in previous.catalogs() ])
+        memo_hits = {}
+        for catalog_hash in previous_hashes & current_hashes:
+            memo_hits[catalog_hash] = memo[catalog_hash]
+        self.assertEqual(
+            sum([ _count_entries(clg) for clg in previous.catalogs() ]),
+            previous.map_catalogs(_count_entries, operator.add, 0, 2, memo))
+        self.assertEqual(current_hashes | previous_hashes, set(memo.keys()))
+        for catalog_hash, memoized in memo_hits.items():
+            self.assertTrue(memo[catalog_hash] is memoized)
+
+        for workers in [ 1, 2 ]:
+            self.assertRaises(Exception, current.map_catalogs,
+                              _fail_on_nested, operator.add, 0, workers)
+        # failures outside of map_fn must not leave the caller waiting
+        for map_fn in [ lambda catalog: 1, _unpicklable_result,
+                        _exit_on_nested ]:
+            self.assertRaises(Exception, current.map_catalogs,
+                              map_fn, operator.add, 0, 2)
+
+    def test_revision_diff(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        def snapshot(rev):
+            nested_flags = 2 | 32
+            return dict([ (path or '/', (dirent.content_hash,
+                                         dirent.flags & ~nested_flags,
+                                         dirent.size, dirent.mode,
+                                         dirent.mtime, dirent.name,
+                                         dirent.symlink))
+                          for path, dirent in cvmfs.RevisionIterator(rev) ])
+        snapshots = dict([ (number, snapshot(repo.get_revision(number)))
+                           for number in [ 1, 2, 3 ] ])
+        for old_number, new_number in [ (1, 2), (2, 3), (1, 3), (3, 1), (3, 3) ]:
+            old, new = snapshots[old_number], snapshots[new_number]
+            expected = \
+              [ (cvmfs.DiffTypes.Added,    p) for p in new if p not in old ] + \
+              [ (cvmfs.DiffTypes.Removed,  p) for p in old if p not in new ] + \
+              [ (cvmfs.DiffTypes.Modified, p) for p in old
+                if p in new and old[p] != new[p] ]
+            changes = list(repo.get_revision(old_number).diff(
+                           repo.get_revision(new_number)))
+            self.assertEqual(sorted(expected),
+                             sorted([ (change, path)
+                                      for change, path, _, _ in changes ]))
+            for change, path, old_dirent, new_dirent in changes:
+                if change != cvmfs.DiffTypes.Added:
+                    self.assertEqual(old[path][0], old_dirent.content_hash)
+                if change != cvmfs.DiffTypes.Removed:
+                    self.assertEqual(new[path][0], new_dirent.content_hash)
+        self.assertEqual({}, repo._pinned_catalogs)
+
+    def test_walk(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        full_walk = [ (path, dirent.flags) for path, dirent in
+                      cvmfs.RevisionIterator(rev) ]
+        def below(prefix, max_depth=None):
+            return sorted([ (path, flags) for path, flags in full_walk
+                            if (path == prefix or path.startswith(prefix + '/'))
+                            and (max_depth is None or
+                                 path.count('/') - prefix.count('/') <= max_depth) ])
+
+        for path in [ '/', '/bar', '/bar/3', '/bar/3/2', '/bar/hello_world' ]:
+            prefix = path if path != '/' else ''
+            self.assertEqual(below(prefix), sorted([ (p, d.flags) for p, d in
+                                                     rev.walk(path) ]))
+        self.assertEqual([], list(rev.walk('/nope')))
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        self.assertEqual(below('/bar/3'),
+                         sorted([ (p, d.flags) for p, d in rev.walk('/bar/3/') ]))
+        self.assertEqual(set([ rev.root_hash, rev._mount_table['/bar/3'] ]),
+                         set(repo._opened_catalogs.keys()))
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        top_level = [ (p, d.flags) for p, d in rev.walk('/', max_depth=1) ]
+        self.assertEqual(sorted([ ('', 1), ('/.cvmfsdirtab', 4), ('/bar', 1),
+                                  ('/foo', 3) ]), sorted(top_level))
+        self.assertEqual([ rev.root_hash ], repo._opened_catalogs.keys())
+        self.assertEqual([ ('/bar', 1) ], [ (p, d.flags) for p, d in
+                                            rev.walk('/bar', max_depth=0) ])
+        bar_children = sorted([ (p, d.flags) for p, d in
+                                rev.walk('/bar', max_depth=1) ])
+        self.assertEqual(('/bar/3', 3), bar_children[3])
+        self.assertEqual(1, len(repo._opened_catalogs))
+        self.assertEqual(below('/bar', 2), sorted([ (p, d.flags) for p, d in
+                                                    rev.walk('/bar', 2) ]))
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        with cvmfs.CatalogPrefetcher(repo) as prefetcher:
+            self.assertEqual(sorted(top_level), sorted([ (p, d.flags) for p, d in
+                             rev.walk('/', max_depth=1, prefetcher=prefetcher) ]))
+            self.assertEqual(0, prefetcher._window_count)
+            self.assertEqual({}, prefetcher._prefetches)
+            self.assertEqual({}, repo._pinned_catalogs)
+            self.assertEqual([ rev.root_hash ], repo._opened_catalogs.keys())
+            self.assertEqual(below('/bar', 2), sorted([ (p, d.flags) for p, d in
+                             rev.walk('/bar', 2, prefetcher=prefetcher) ]))
+            self.assertEqual({}, repo._pinned_catalogs)
+
+
+    def test_reference_filter(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        full_walk = [ path for path, _ in cvmfs.RevisionIterator(rev) ]
+        filters = cvmfs.CatalogReferenceFilters
+        bar_mounts = tuple([ '/bar/%d' % i for i in range(1, 5) ])
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        catalogs = [ c.root_prefix for c in
+                     rev.catalogs(reference_filter=filters.path_prefix('/bar/3/1')) ]
+        self.assertEqual([ '/', '/bar/3' ], catalogs)
+        self.assertEqual(2, len(repo._opened_catalogs))
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        walk = [ path for path, _ in cvmfs.RevisionIterator(rev,
+                     reference_filter=filters.all_of(filters.max_depth(1),
+                                                     filters.max_size(1 << 20))) ]
+        self.assertEqual([ p for p in full_walk
+                           if not p.startswith(bar_mounts) ], walk)
+        self.assertEqual(2, len(repo._opened_catalogs))
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        with cvmfs.CatalogPrefetcher(repo) as prefetcher:
+            walk = [ path for path, _ in cvmfs.RevisionIterator(rev,
+                         prefetcher=prefetcher,
+                         reference_filter=filters.max_size(1024)) ]
+        self.assertEqual([ p for p in full_walk
+                           if not p.startswith(('/foo',) + bar_mounts) ], walk)
+        self.assertEqual([ rev.root_hash ], repo._opened_catalogs.keys())
+        self.assertEqual({}, repo._pinned_catalogs)
+
+    def test_walk_dirs(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        tree = collections.defaultdict(lambda: ([], []))
+        for path, dirent in cvmfs.RevisionIterator(rev):
+            if path == '':
+                continue
+            parent, name = path.rsplit('/', 1)
+            tree[parent or '/'][0 if dirent.is_directory() else 1].append(name)
+        expected = sorted([ (path, sorted(dirs), sorted(files))
+                            for path, (dirs, files) in tree.items() ] +
+                          [ (path, [], []) for path, dirent in
+                            cvmfs.RevisionIterator(rev)
+                            if dirent.is_directory() and
+                               (path or '/') not in tree ])
+
+        walk = list(rev.walk_dirs('/'))
+        self.assertEqual('/', walk[0][0])
+        self.assertEqual(expected, sorted([ (p, sorted(d), sorted(f))
+                                            for p, d, f in walk ]))
+        bottom_up = list(rev.walk_dirs('/', topdown=False))
+        self.assertEqual('/', bottom_up[-1][0])
+        self.assertEqual(sorted(walk), sorted(bottom_up))
+        for dirpath, dirnames, _ in bottom_up:
+            for dirname in dirnames:
+                child = (dirpath.rstrip('/') + '/' + dirname)
+                self.assertTrue([ w[0] for w in bottom_up ].index(child) <
+                                [ w[0] for w in bottom_up ].index(dirpath))
+
+        bar = [ w for w in expected if w[0] == '/bar' or
+                w[0].startswith('/bar/') ]
+        self.assertEqual(bar, sorted([ (p, sorted(d), sorted(f)) for p, d, f
+                                       in rev.walk_dirs('/bar/') ]))
+        pruned = []
+        for dirpath, dirnames, _ in rev.walk_dirs('/'):
+            pruned.append(dirpath)
+            if dirpath == '/':
+                dirnames[:] = [ d for d in dirnames if d != 'bar' ]
+        self.assertEqual(sorted([ w[0] for w in expected
+                                  if not w[0].startswith('/bar') ]),
+                         sorted(pruned))
+
+        _, _, entries = next(rev.walk_dirs('/bar/3', entries=True))
+        self.assertTrue(all([ isinstance(e, DirectoryEntry) and
+                              not e.is_directory() for e in entries ]))
+        self.assertEqual(sorted([ e.name for e in entries ]),
+                         [ w for w in expected if w[0] == '/bar/3' ][0][2])
+        self.assertEqual([], list(rev.walk_dirs('/nope')))
+        self.assertEqual([], list(rev.walk_dirs('/bar/hello_world')))
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        # nested catalogs are only retrieved once they are walked
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        repo.max_open_catalogs = 2
+        rev = repo.get_current_revision()
+        for dirpath, _, _ in rev.walk_dirs('/'):
+            self.assertTrue(len(repo._pinned_catalogs) <= 2, dirpath)
+            self.assertTrue(len(repo._opened_catalogs) <= 2, dirpath)
+
+    def test_checkpointed_iteration(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        full_walk = [ path for path, _ in cvmfs.RevisionIterator(rev) ]
+        checkpoint = os.path.join(self.sandbox.temporary_dir, 'walk.state')
+
+        for interrupt_after in range(1, len(full_walk), 3):
+            iterator = cvmfs.RevisionIterator(rev, checkpoint_file=checkpoint,
+                                              checkpoint_interval=4)
+            walked = [ path for path, _ in
+                       itertools.islice(iterator, interrupt_after) ]
+            iterator.close()
+            saved = (interrupt_after - 1) // 4 * 4
+            if saved == 0:
+                self.assertFalse(os.path.exists(checkpoint))
+                continue
+            repo = cvmfs.open_repository(self.mock_repo.dir)
+            rev = repo.get_current_revision()
+            with cvmfs.CatalogPrefetcher(repo) as prefetcher:
+                resumed = [ path for path, _ in
+                            cvmfs.RevisionIterator(rev, prefetcher=prefetcher,
+                                                   checkpoint_file=checkpoint) ]
+            self.assertEqual(full_walk, walked[:saved] + resumed)
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertEqual({}, repo._pinned_catalogs)
+
+        iterator = cvmfs.RevisionIterator(rev.repository.get_revision(2),
+                                          checkpoint_file=checkpoint,
+                                          checkpoint_interval=1)
+        list(itertools.islice(iterator, 3))
+        self.assertRaises(cvmfs.CheckpointMismatch, cvmfs.RevisionIterator,
+                          rev, checkpoint_file=checkpoint)
+        iterator.close()
+        os.remove(checkpoint)
+
+        iterator = cvmfs.RevisionIterator(rev, path='/bar', max_depth=2,
+                                          checkpoint_file=checkpoint,
+                                          checkpoint_interval=2)
+        expected = [ path for path, _ in rev.walk('/bar', max_depth=2) ]
+        walked = [ path for path, _ in itertools.islice(iterator, 7) ]
+        resumed = [ path for path, _ in
+                    cvmfs.RevisionIterator(rev, checkpoint_file=checkpoint) ]
+        self.assertEqual(expected, walked[:6] + resumed)
+
+    def test_memory_bounded_iteration(self):
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        full_walk = [ (path, dirent.md5path_1, dirent.md5path_2)
+                      for path, dirent in cvmfs.RevisionIterator(rev) ]
+
+        repo = cvmfs.open_repository(self.mock_repo.dir)
+        rev = repo.get_current_revision()
+        opened = []
+        def finish_catalog(catalog):
+            opened.append(len(repo._opened_catalogs))
+        iterator = cvmfs.RevisionIterator(rev, memory_bounded=True,
+                                          finish_catalog_callback=finish_catalog)
+        walk = []
+        for path, dirent in iterator:
+            walk.append((path, dirent.md5path_1, dirent.md5path_2))
+            self.assertEqual(len(iterator.catalog_stack),
+                             len(repo._opened_catalogs))
+        self.assertEqual(full_walk, walk)
+        self.assertEqual(6, len(opened))
+        self.assertTrue(max(opened) <= 2)
+        self.assertEqual(0, len(repo._opened_catalogs))
+        self.assertEqual({}, repo._pinned_catalogs)
+
+        root_catalog = rev.retrieve_root_catalog()
+        foo_catalog = rev.retrieve_catalog_for_path('/foo')
+        self.assertEqual(full_walk, [ (path, dirent.md5path_1, dirent.md5path_2)
+                                      for path, dirent in
+                                      cvmfs.RevisionIterator(rev,
+                                          memory_bounded=True) ])
+        self.assertFalse(root_catalog.closed)
+        self.assertTrue(repo.is_catalog_cached(root_catalog.hash))
+        self.assertTrue(repo.is_catalog_cached(foo_catalog.hash))
+        self.assertEqual(2, len(repo._opened_catalogs))
+        self.assertTrue(root_catalog.find_directory_entry('/bar') is not None)
+        self.assertTrue(foo_catalog.find_directory_entry('/foo') is not None)
+        self.assertEqual({}, repo._pinned_catalogs)